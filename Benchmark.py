@@ -0,0 +1,830 @@
+#  This code runs Stats.py and Summarize.py against local stand-ins for Tableau Public, Google Sheets, S3 and SES, so their
+#  throughput can be measured without touching the real services. Run it before deploying to catch performance regressions.
+#
+#  Usage: python Benchmark.py [scenario ...] [--api-latency MS] [--api-error-rate RATE] [--save FILE] [--compare FILE] ...
+#         python Benchmark.py --help for the full list of options.
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import tracemalloc
+import tempfile
+import urllib.parse
+import resource
+import boto3
+import gspread
+import requests
+from contextlib import redirect_stdout
+from botocore.exceptions import ClientError
+from oauth2client.service_account import ServiceAccountCredentials
+
+import Stats
+import Summarize
+
+# Scenarios: number of profiles on the sign-up sheet and number of workbooks on each profile.
+scenarios = {
+    "smoke": {"profiles": 5, "workbooks": 20},
+    "many": {"profiles": 1000, "workbooks": 50},
+    "large": {"profiles": 1, "workbooks": 5000},
+}
+
+# Stand-in defaults. Latencies are the mean, in ms, of each call; every call waits between half and one and a half times that.
+apiLatency = 50                                                         # Latency of each Tableau Public API call.
+apiErrorRate = 0.0                                                      # Share of API calls that fail with apiErrorStatus.
+apiErrorStatus = 503                                                    # Status returned by the failed API calls.
+apiDropRate = 0.0                                                       # Share of API calls that fail with a connection error.
+apiPageSize = 50                                                        # Most workbooks the workbooks API returns per page.
+apiEtags = False                                                        # Send ETags from the profile API and honor If-None-Match.
+sheetsLatency = 150                                                     # Latency of each Google Sheets call.
+sheetsErrorRate = 0.0                                                   # Share of Sheets calls that fail with a quota error.
+sheetsPerMinute = 60000                                                 # Sheets quota used in place of the real one.
+apiBackoff = 0.05                                                       # Base retry delay, in seconds, used in place of the real one.
+churnRate = 0.1                                                         # Share of workbooks that change between passes.
+maxInvocations = 50                                                     # Most invocations to allow for a single pass.
+
+# A regression is reported when a result is this many percent worse than the saved baseline.
+compareTolerance = 10
+
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Log a message.
+#------------------------------------------------------------------------------------------------------------------------------
+def log (msg):
+    logTimeStamp = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    print(str(logTimeStamp) + ": " + msg)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Wait for a stand-in call, between half and one and a half times the mean latency (ms).
+#------------------------------------------------------------------------------------------------------------------------------
+def simulate_latency (latency):
+    if latency > 0:
+        time.sleep(latency * random.uniform(0.5, 1.5) / 1000)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Stand-in for an HTTP response, used for the Tableau Public API and for Google API errors.
+#------------------------------------------------------------------------------------------------------------------------------
+class FakeResponse:
+    def __init__ (self, status, data, headers=None):
+        self.status_code = status
+        self.headers = headers or {}
+        self.content = json.dumps(data).encode("utf-8") if data is not None else b""
+        self.text = self.content.decode("utf-8")
+        self.data = data
+
+    def json (self):
+        return self.data
+
+    def raise_for_status (self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(str(self.status_code) + " Error", response=self)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Stand-in for the Tableau Public profile, workbooks and single_workbook APIs. Profiles and workbooks are generated from a seed,
+# so every run of a scenario sees the same data.
+#------------------------------------------------------------------------------------------------------------------------------
+class FakeTableau:
+    def __init__ (self, profileCount, workbookCount, seed=1):
+        self.random = random.Random(seed)
+        self.profiles = {}
+        self.workbooks = {}
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+        for p in range(0, profileCount):
+            profileID = "bench.profile." + str(p)
+            workbooks = []
+
+            for w in range(0, workbookCount):
+                workbookID = "BenchViz" + str(p) + "_" + str(w)
+                published = 1500000000000 + self.random.randint(0, 10**11)
+
+                workbook = {
+                    "workbookRepoUrl": workbookID,
+                    "title": "Benchmark Viz " + str(w),
+                    "description": "Viz " + str(w) + " of " + profileID,
+                    "defaultViewRepoUrl": workbookID + "/sheets/Dashboard",
+                    "defaultViewName": "Dashboard",
+                    "showInProfile": self.random.random() > 0.1,
+                    "permalink": "https://public.tableau.com/views/" + workbookID + "/Dashboard",
+                    "viewCount": self.random.randint(0, 100000),
+                    "numberOfFavorites": self.random.randint(0, 500),
+                    "firstPublishDate": published,
+                    "lastPublishDate": published,
+                    "revision": "1.0",
+                    "size": self.random.randint(10000, 10**7),
+                }
+
+                workbooks.append(workbook)
+                self.workbooks[workbookID] = workbook
+
+            self.profiles[profileID] = {
+                "name": "Benchmark User " + str(p),
+                "profileName": profileID,
+                "organization": "Benchmark",
+                "bio": "Generated profile",
+                "avatarUrl": "",
+                "searchable": True,
+                "featuredVizRepoUrl": workbooks[0]["workbookRepoUrl"] if len(workbooks) > 0 else "",
+                "totalNumberOfFollowers": self.random.randint(0, 5000),
+                "totalNumberOfFollowing": self.random.randint(0, 500),
+                "websites": [{"title": "twitter.com", "url": "https://twitter.com/" + profileID}],
+                "address": json.dumps({"country": "United States", "state": "Ohio", "city": "Cleveland"}),
+                "workbooks": workbooks,
+            }
+
+    def reset_counters (self):
+        with self.lock:
+            self.calls = {"profile": 0, "workbooks": 0, "single_workbook": 0, "errors": 0, "drops": 0}
+
+    # Change the counters of a share of the workbooks, and republish some of those, as happens between daily refreshes. The
+    # same share of profiles gain a follower.
+    def churn (self, rate):
+        for profile in self.profiles.values():
+            if self.random.random() < rate:
+                profile["totalNumberOfFollowers"] += 1
+
+        for workbook in self.workbooks.values():
+            if self.random.random() < rate:
+                workbook["viewCount"] += self.random.randint(1, 100)
+                workbook["numberOfFavorites"] += self.random.randint(0, 2)
+
+                if self.random.random() < 0.2:
+                    workbook["lastPublishDate"] += 86400000
+                    workbook["revision"] = str(round(float(workbook["revision"]) + 0.1, 1))
+
+    # Replaces Stats.session.get.
+    def get (self, url, params=None, timeout=None, **kwargs):
+        simulate_latency(apiLatency)
+
+        if random.random() < apiDropRate:
+            with self.lock:
+                self.calls["drops"] += 1
+            raise requests.exceptions.ConnectionError("Benchmark dropped connection: " + url)
+
+        if random.random() < apiErrorRate:
+            with self.lock:
+                self.calls["errors"] += 1
+            return FakeResponse(apiErrorStatus, {"message": "Benchmark error"})
+
+        if "/single_workbook/" in url:
+            endpoint = "single_workbook"
+            workbookID = url.split("/single_workbook/")[1].rstrip("?")
+            workbook = self.workbooks.get(workbookID)
+
+            if workbook is None:
+                response = FakeResponse(404, {"message": "Workbook not found"})
+            else:
+                response = FakeResponse(200, dict(workbook))
+
+        elif url.startswith(Stats.urlProfileWB):
+            endpoint = "workbooks"
+            profile = self.profiles.get(params["profileName"], {"workbooks": []})
+            start = int(params["start"])
+            count = min(int(params["count"]), apiPageSize)
+            page = profile["workbooks"][start:start+count]
+
+            # The list only carries some of each workbook's details.
+            fields = ["workbookRepoUrl", "title", "viewCount", "numberOfFavorites", "lastPublishDate", "revision", "showInProfile", "defaultViewRepoUrl"]
+            contents = [{field: workbook[field] for field in fields} for workbook in page]
+
+            if start + count >= len(profile["workbooks"]):
+                next = -1
+            else:
+                next = start + count
+
+            response = FakeResponse(200, {"contents": contents, "next": next})
+
+        elif "/profile/api/" in url:
+            endpoint = "profile"
+            profile = self.profiles.get(url.split("/profile/api/")[1].rstrip("/"))
+
+            if profile is None:
+                response = FakeResponse(404, {"message": "Profile not found"})
+            else:
+                response = FakeResponse(200, {k: v for k, v in profile.items() if k != "workbooks"})
+
+                if apiEtags == True:
+                    etag = '"' + hashlib.md5(response.content).hexdigest() + '"'
+                    if (kwargs.get("headers") or {}).get("If-None-Match") == etag:
+                        response = FakeResponse(304, None)
+                    response.headers["ETag"] = etag
+
+        else:
+            raise requests.exceptions.InvalidURL("Benchmark has no stand-in for: " + url)
+
+        with self.lock:
+            self.calls[endpoint] += 1
+
+        return response
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Stand-in for the Google Sheets API. Holds every spreadsheet and counts calls. Each call waits for sheetsLatency, and a share
+# of them fail with a quota error (429).
+#------------------------------------------------------------------------------------------------------------------------------
+class FakeSheets:
+    def __init__ (self):
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.credentials = FakeCredentials()
+        self.tokenRefreshes = 0
+        self.reset_counters()
+
+    def reset_counters (self):
+        with self.lock:
+            self.calls = {"read": 0, "write": 0, "quota": 0}
+
+    def call (self, kind):
+        simulate_latency(sheetsLatency)
+
+        with self.lock:
+            self.calls[kind] += 1
+
+            if random.random() < sheetsErrorRate:
+                self.calls["quota"] += 1
+                error = {"error": {"code": 429, "message": "Benchmark quota exceeded", "status": "RESOURCE_EXHAUSTED"}}
+                raise gspread.exceptions.APIError(FakeResponse(429, error))
+
+    def add (self, title):
+        with self.lock:
+            self.created += 1
+            key = "bench-sheet-" + str(self.created)
+            doc = FakeSpreadsheet(self, key, title)
+            self.docs[key] = doc
+
+        return doc
+
+    # Replaces gspread.authorize.
+    def authorize (self, credentials):
+        return FakeClient(self)
+
+    # Answer a Sheets API request sent by a real gspread worksheet, which Stats and Summarize build from the sheet index. Only the
+    # values and batchUpdate endpoints they use are handled.
+    def request (self, method, endpoint, params=None, json=None, **kwargs):
+        path = endpoint.split("/spreadsheets/")[1]
+
+        if path.endswith(":batchUpdate"):
+            doc = self.get_doc(path[:-len(":batchUpdate")], "write")
+            return FakeResponse(200, doc.batch_update(json))
+
+        key, rangeName = path.split("/values/")
+        doc = self.get_doc(key, "read")
+        rangeName = urllib.parse.unquote(rangeName)
+        title, cells = rangeName.rsplit("!", 1)
+        title = title.strip("'").replace("''", "'")
+
+        for tab in doc.tabs:
+            if tab.title == title:
+                formatted = (params or {}).get("valueRenderOption") != "UNFORMATTED_VALUE"
+                return FakeResponse(200, {"range": rangeName, "majorDimension": "ROWS", "values": tab.get_values(cells, None if formatted else "UNFORMATTED_VALUE")})
+
+        raise gspread.exceptions.APIError(FakeResponse(400, {"error": {"code": 400, "message": "Unable to parse range: " + rangeName, "status": "INVALID_ARGUMENT"}}))
+
+    def get_doc (self, key, kind):
+        if key not in self.docs:
+            self.call(kind)
+            raise gspread.exceptions.APIError(FakeResponse(404, {"error": {"code": 404, "message": "Requested entity was not found.", "status": "NOT_FOUND"}}))
+
+        return self.docs[key]
+
+class FakeCredentials:
+    def __init__ (self):
+        self.token = None
+        self.expiry = None
+
+# Stand-in for the client's HTTP client, which holds the credentials, refreshes the token and sends the requests. gspread 6 checks
+# that a worksheet's client is an HTTPClient.
+class FakeHTTPClient (gspread.http_client.HTTPClient if hasattr(gspread, "http_client") else object):
+    def __init__ (self, sheets):
+        self.sheets = sheets
+        self.auth = sheets.credentials
+
+    def login (self):
+        with self.sheets.lock:
+            self.sheets.tokenRefreshes += 1
+
+        self.auth.token = "bench-token-" + str(self.sheets.tokenRefreshes)
+        self.auth.expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(hours=1)
+
+    def request (self, method, endpoint, **kwargs):
+        return self.sheets.request(method, endpoint, **kwargs)
+
+# Laid out like the installed gspread's client: gspread 6 moved the credentials and login onto Client.http_client, while older
+# versions keep them on the client itself.
+class FakeClient:
+    def __init__ (self, sheets):
+        self.sheets = sheets
+        httpClient = FakeHTTPClient(sheets)
+
+        if hasattr(gspread, "http_client"):
+            self.http_client = httpClient
+        else:
+            self.auth = httpClient.auth
+            self.login = httpClient.login
+            self.request = httpClient.request
+
+    def open_by_key (self, key):
+        self.sheets.call("read")
+
+        if key not in self.sheets.docs:
+            raise gspread.exceptions.SpreadsheetNotFound(key)
+
+        return self.sheets.docs[key]
+
+    def open_by_url (self, url):
+        return self.open_by_key(url.split("/d/")[1].split("/")[0])
+
+    def create (self, title):
+        self.sheets.call("write")
+        return self.sheets.add(title)
+
+class FakeSpreadsheet:
+    def __init__ (self, sheets, key, title):
+        self.sheets = sheets
+        self.id = key
+        self.title = title
+        self.url = "https://docs.google.com/spreadsheets/d/" + key
+        self.shares = []
+        self.tabs = [FakeWorksheet(self, 0, "Sheet1")]
+
+    def add_worksheet (self, title):
+        tab = FakeWorksheet(self, len(self.tabs), title)
+        self.tabs.append(tab)
+        return tab
+
+    def get_worksheet (self, index):
+        self.sheets.call("read")
+        return self.tabs[index]
+
+    def worksheet (self, title):
+        self.sheets.call("read")
+
+        for tab in self.tabs:
+            if tab.title == title:
+                return tab
+
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def share (self, email, perm_type, role, **kwargs):
+        self.sheets.call("write")
+        self.shares.append((email, perm_type, role))
+
+    def batch_update (self, body):
+        self.sheets.call("write")
+        tabs = {tab.id: tab for tab in self.tabs}
+
+        for request in body["requests"]:
+            if "updateCells" in request:
+                update = request["updateCells"]
+
+                if "range" in update:
+                    area = update["range"]
+                    tab = self.get_tab(tabs, area["sheetId"])
+                    tab.clear_area(area.get("startRowIndex", 0), area.get("endRowIndex"), area.get("startColumnIndex", 0), area.get("endColumnIndex"))
+                    r0 = area.get("startRowIndex", 0)
+                    c0 = area.get("startColumnIndex", 0)
+                else:
+                    tab = self.get_tab(tabs, update["start"]["sheetId"])
+                    r0 = update["start"].get("rowIndex", 0)
+                    c0 = update["start"].get("columnIndex", 0)
+
+                for r, row in enumerate(update.get("rows", [])):
+                    for c, cell in enumerate(row.get("values", [])):
+                        value = list(cell.get("userEnteredValue", {"stringValue": None}).values())[0]
+                        tab.set_value(r0 + r, c0 + c, value)
+
+            elif "updateSheetProperties" in request:
+                properties = request["updateSheetProperties"]["properties"]
+                tab = self.get_tab(tabs, properties["sheetId"])
+
+                if "title" in properties:
+                    tab.title = properties["title"]
+                tab.gridProperties.update(properties.get("gridProperties", {}))
+
+        return {"spreadsheetId": self.id, "replies": []}
+
+    # The API rejects the whole request if it names a worksheet that isn't there.
+    def get_tab (self, tabs, sheetId):
+        if sheetId not in tabs:
+            raise gspread.exceptions.APIError(FakeResponse(400, {"error": {"code": 400, "message": "No grid with id: " + str(sheetId), "status": "INVALID_ARGUMENT"}}))
+
+        return tabs[sheetId]
+
+class FakeWorksheet:
+    def __init__ (self, spreadsheet, sheetId, title):
+        self.spreadsheet = spreadsheet
+        self.id = sheetId
+        self.title = title
+        self.gridProperties = {"rowCount": 1000, "columnCount": 26, "frozenRowCount": 0}
+        self.values = []
+
+    row_count = property(lambda self: self.gridProperties["rowCount"])
+    col_count = property(lambda self: self.gridProperties["columnCount"])
+    frozen_row_count = property(lambda self: self.gridProperties["frozenRowCount"])
+
+    # Values are stored in a list of rows, with None for empty cells.
+    def set_value (self, r, c, value):
+        while len(self.values) <= r:
+            self.values.append([])
+
+        row = self.values[r]
+        while len(row) <= c:
+            row.append(None)
+
+        row[c] = value
+
+    def clear_area (self, r0, r1, c0, c1):
+        for row in self.values[r0:r1]:
+            for c in range(c0, min(len(row), c1 if c1 is not None else len(row))):
+                row[c] = None
+
+    # Read a block of values the way the API returns them: trailing empty rows and cells are left off, and formatted values are
+    # strings, with TRUE/FALSE for booleans.
+    def read_area (self, r0, r1, c0, c1, formatted=True):
+        rows = []
+
+        for row in self.values[r0:r1]:
+            cells = row[c0:c1]
+            while len(cells) > 0 and cells[-1] in [None, ""]:
+                cells = cells[:-1]
+
+            rows.append([format_value(value) if formatted else ("" if value is None else value) for value in cells])
+
+        while len(rows) > 0 and len(rows[-1]) == 0:
+            rows.pop()
+
+        return rows
+
+    def get_values (self, range_name=None, value_render_option=None, **kwargs):
+        self.spreadsheet.sheets.call("read")
+        area = gspread.utils.a1_range_to_grid_range(range_name) if range_name is not None else {}
+        formatted = value_render_option != "UNFORMATTED_VALUE"
+        return self.read_area(area.get("startRowIndex", 0), area.get("endRowIndex"), area.get("startColumnIndex", 0), area.get("endColumnIndex"), formatted)
+
+    def col_values (self, col, **kwargs):
+        self.spreadsheet.sheets.call("read")
+        values = [row[0] if len(row) > 0 else "" for row in self.read_area(0, None, col-1, col)]
+        return values
+
+    def range (self, name):
+        self.spreadsheet.sheets.call("read")
+        area = gspread.utils.a1_range_to_grid_range(name)
+        cells = []
+
+        for r in range(area["startRowIndex"], area["endRowIndex"]):
+            for c in range(area["startColumnIndex"], area["endColumnIndex"]):
+                value = self.values[r][c] if r < len(self.values) and c < len(self.values[r]) else None
+                cells.append(gspread.cell.Cell(r+1, c+1, format_value(value)))
+
+        return cells
+
+    def update_cells (self, cell_list, **kwargs):
+        self.spreadsheet.sheets.call("write")
+
+        for cell in cell_list:
+            self.set_value(cell.row-1, cell.col-1, cell.value)
+
+    def batch_update (self, data, **kwargs):
+        self.spreadsheet.sheets.call("write")
+
+        for update in data:
+            area = gspread.utils.a1_range_to_grid_range(update["range"])
+            for r, row in enumerate(update["values"]):
+                for c, value in enumerate(row):
+                    self.set_value(area["startRowIndex"] + r, area["startColumnIndex"] + c, value)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Format a stored value as the Sheets API does for FORMATTED_VALUE reads.
+#------------------------------------------------------------------------------------------------------------------------------
+def format_value (value):
+    if value is None:
+        return ""
+    elif isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    else:
+        return str(value)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Stand-ins for the S3 and SES clients.
+#------------------------------------------------------------------------------------------------------------------------------
+class FakeS3:
+    def __init__ (self):
+        self.objects = {}
+        self.calls = 0
+
+    def get_object (self, Bucket, Key, **kwargs):
+        self.calls += 1
+
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, "GetObject")
+
+        return {"Body": FakeBody(self.objects[Key])}
+
+    def put_object (self, Bucket, Key, Body, **kwargs):
+        self.calls += 1
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {}
+
+    def head_object (self, Bucket, Key, **kwargs):
+        self.calls += 1
+
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+
+        return {"ETag": '"' + hashlib.md5(self.objects[Key]).hexdigest() + '"', "ContentLength": len(self.objects[Key])}
+
+    def download_file (self, Bucket, Key, Filename, **kwargs):
+        self.calls += 1
+
+        with open(Filename, "wb") as f:
+            f.write(self.objects[Key])
+
+    def upload_file (self, Filename, Bucket, Key, **kwargs):
+        self.calls += 1
+
+        with open(Filename, "rb") as f:
+            self.objects[Key] = f.read()
+
+    def upload_fileobj (self, Fileobj, Bucket, Key, **kwargs):
+        self.calls += 1
+        self.objects[Key] = Fileobj.read()
+
+class FakeBody:
+    def __init__ (self, content):
+        self.content = content
+
+    def read (self):
+        return self.content
+
+class FakeSES:
+    def __init__ (self):
+        self.sent = []
+
+    def send_email (self, **kwargs):
+        self.sent.append(kwargs["Message"]["Subject"]["Data"])
+        return {"MessageId": "bench-" + str(len(self.sent))}
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build the stand-ins for a scenario and swap them in for the real services, in both Stats and Summarize. The sign-up sheet
+# gets one row per profile, with no stats URL yet, plus an empty Summary sheet.
+#------------------------------------------------------------------------------------------------------------------------------
+def install_fakes (profileCount, workbookCount):
+    fakes = {}
+    fakes["tableau"] = FakeTableau(profileCount, workbookCount)
+    fakes["sheets"] = FakeSheets()
+    fakes["s3"] = FakeS3()
+    fakes["ses"] = FakeSES()
+
+    fakes["s3"].objects[Stats.credsFile] = b"{}"
+
+    signup = fakes["sheets"].add("Sign-Up")
+    del fakes["sheets"].docs[signup.id]
+    signup.id = Stats.worksheetID
+    fakes["sheets"].docs[signup.id] = signup
+
+    sheetProfiles = signup.tabs[0]
+    sheetProfiles.title = "Form Responses 1"
+    sheetProfiles.values.append(["Timestamp", "Email Address", "First Name", "Last Name", "Profile ID", "Stats URL", "Last Refreshed"])
+    for p, profileID in enumerate(fakes["tableau"].profiles):
+        sheetProfiles.values.append(["2021-03-01 00:00:00", "user" + str(p) + "@example.com", "User", str(p), profileID])
+
+    sheetSummary = signup.add_worksheet("Summary")
+    sheetSummary.values.append(["First Name", "Last Name", "Profile ID", "Stats URL", "Favorites", "Views", "Followers", "Following", "Vizzes", "Last Refreshed", "Summarized"])
+
+    # Swap in the stand-ins. Stats and Summarize share the boto3, gspread and oauth2client modules.
+    boto3.client = lambda service, **kwargs: fakes["s3"] if service == "s3" else fakes["ses"]
+    gspread.authorize = fakes["sheets"].authorize
+    ServiceAccountCredentials.from_json_keyfile_dict = staticmethod(lambda creds, scope: None)
+    Stats.session.get = fakes["tableau"].get
+
+    # Start cold, without the clients cached by the last scenario.
+    for module in [Stats, Summarize]:
+        module.clientCache.clear()
+        module.sheetsReads = module.TokenBucket(sheetsPerMinute)
+        module.sheetsWrites = module.TokenBucket(sheetsPerMinute)
+
+    Stats.apiBackoff = apiBackoff
+    Stats.workbookPageSize = Stats.workbookPageMax
+
+    # Keep the workbook history database in a scratch directory, starting empty.
+    Stats.historyPath = os.path.join(tempfile.mkdtemp(prefix="stats-bench-"), "stats-history.db")
+    Stats.historyETag = None
+    return fakes
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Make every profile on the sign-up sheet due for a refresh again.
+#------------------------------------------------------------------------------------------------------------------------------
+def age_profiles (fakes):
+    sheetProfiles = fakes["sheets"].docs[Stats.worksheetID].tabs[0]
+    aged = (datetime.datetime.now() - datetime.timedelta(hours=Stats.refreshHours+1)).strftime("%Y-%m-%d %H:%M:%S")
+
+    for row in sheetProfiles.values[1:]:
+        if len(row) > 6 and row[6] not in [None, ""]:
+            row[6] = aged
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Run a lambda handler with its log output discarded (unless verbose), measuring wall time and peak traced memory. Stats ends
+# an invocation that hits maxRuntime with exit(), so the SystemExit is caught and reported.
+#------------------------------------------------------------------------------------------------------------------------------
+def run_handler (module, verbose):
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    exited = False
+
+    with open(os.devnull, "w") as devnull:
+        with redirect_stdout(sys.stdout if verbose else devnull):
+            try:
+                module.lambda_handler({}, None)
+            except SystemExit:
+                exited = True
+
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+
+    return {"seconds": seconds, "peak": peak, "exited": exited, "counts": dict(module.metricCounts)}
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Run one pass of Stats over every profile, invoking the handler again (as the schedule would) until it finishes a pass.
+#------------------------------------------------------------------------------------------------------------------------------
+def run_stats_pass (fakes, verbose):
+    fakes["tableau"].reset_counters()
+    fakes["sheets"].reset_counters()
+    emailsSent = len(fakes["ses"].sent)
+
+    seconds = 0
+    peak = 0
+    refreshed = 0
+    invocations = 0
+    exited = True
+
+    while exited == True and invocations < maxInvocations:
+        run = run_handler(Stats, verbose)
+
+        invocations += 1
+        seconds += run["seconds"]
+        peak = max(peak, run["peak"])
+        refreshed += run["counts"].get("ProfilesRefreshed", 0)
+        exited = run["exited"]
+
+    calls = fakes["tableau"].calls
+    apiCalls = calls["profile"] + calls["workbooks"] + calls["single_workbook"] + calls["errors"] + calls["drops"]
+
+    result = {}
+    result["seconds"] = round(seconds, 2)
+    result["invocations"] = invocations
+    result["profilesRefreshed"] = refreshed
+    result["profilesPerMinute"] = round(refreshed / seconds * 60, 1) if seconds > 0 else 0
+    result["apiCalls"] = apiCalls
+    result["apiCallsPerProfile"] = round(apiCalls / refreshed, 2) if refreshed > 0 else 0
+    result["detailCalls"] = calls["single_workbook"]
+    result["sheetsReads"] = fakes["sheets"].calls["read"]
+    result["sheetsWrites"] = fakes["sheets"].calls["write"]
+    result["sheetsCallsPerProfile"] = round((result["sheetsReads"] + result["sheetsWrites"]) / refreshed, 2) if refreshed > 0 else 0
+    result["emailsSent"] = len(fakes["ses"].sent) - emailsSent
+    result["peakMB"] = round(peak / 1024 / 1024, 1)
+    return result
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Run Summarize once over every stats sheet.
+#------------------------------------------------------------------------------------------------------------------------------
+def run_summarize (fakes, verbose):
+    fakes["sheets"].reset_counters()
+    run = run_handler(Summarize, verbose)
+    summarized = run["counts"].get("ProfilesSummarized", 0)
+
+    result = {}
+    result["seconds"] = round(run["seconds"], 2)
+    result["profilesSummarized"] = summarized
+    result["profilesPerMinute"] = round(summarized / run["seconds"] * 60, 1) if run["seconds"] > 0 else 0
+    result["sheetsReads"] = fakes["sheets"].calls["read"]
+    result["sheetsWrites"] = fakes["sheets"].calls["write"]
+    result["peakMB"] = round(run["peak"] / 1024 / 1024, 1)
+    return result
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Run a scenario: a first pass that creates every stats sheet, then warm passes after some of the workbooks have changed,
+# then Summarize.
+#------------------------------------------------------------------------------------------------------------------------------
+def run_scenario (name, profileCount, workbookCount, passes, verbose):
+    log ("Scenario " + name + ": " + str(profileCount) + " profiles x " + str(workbookCount) + " workbooks.")
+    fakes = install_fakes(profileCount, workbookCount)
+    results = {}
+
+    for n in range(0, passes):
+        if n > 0:
+            fakes["tableau"].churn(churnRate)
+            age_profiles(fakes)
+
+        label = "stats-cold" if n == 0 else "stats-warm" + (str(n) if passes > 2 else "")
+        results[label] = run_stats_pass(fakes, verbose)
+        log_result(name, label, results[label])
+
+    results["summarize"] = run_summarize(fakes, verbose)
+    log_result(name, "summarize", results["summarize"])
+
+    return results
+
+def log_result (name, label, result):
+    log ("  " + name + " " + label + ": " + ", ".join(key + " " + str(value) for key, value in result.items()))
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Compare results with a saved baseline. Throughput that drops, or calls and memory that grow, by more than the tolerance are
+# reported as regressions. Returns the number of regressions.
+#------------------------------------------------------------------------------------------------------------------------------
+def compare_results (results, baseline, tolerance):
+    higherIsBetter = ["profilesPerMinute"]
+    lowerIsBetter = ["apiCallsPerProfile", "sheetsCallsPerProfile", "sheetsReads", "sheetsWrites", "peakMB"]
+    regressions = 0
+
+    for scenario, runs in results.items():
+        for label, result in runs.items():
+            old = baseline.get(scenario, {}).get(label)
+            if old is None:
+                continue
+
+            for key in higherIsBetter + lowerIsBetter:
+                if key not in result or key not in old or old[key] == 0:
+                    continue
+
+                change = (result[key] - old[key]) / old[key] * 100
+                if key in higherIsBetter:
+                    change = -change
+
+                if change > tolerance:
+                    log ("Regression in " + scenario + " " + label + " " + key + ": " + str(old[key]) + " -> " + str(result[key]) + ".")
+                    regressions += 1
+
+    return regressions
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Main
+#------------------------------------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Stats.py and Summarize.py against local stand-ins.")
+    parser.add_argument("scenarios", nargs="*", default=["smoke"], help="Scenarios to run: " + ", ".join(scenarios) + ", or PROFILESxWORKBOOKS (e.g. 200x30).")
+    parser.add_argument("--passes", type=int, default=2, help="Stats passes per scenario. The first creates the sheets; the rest refresh them.")
+    parser.add_argument("--api-latency", type=float, default=apiLatency, help="Mean Tableau Public API latency, in ms.")
+    parser.add_argument("--api-error-rate", type=float, default=apiErrorRate, help="Share of API calls that return an error status.")
+    parser.add_argument("--api-error-status", type=int, default=apiErrorStatus, help="Status returned by failed API calls.")
+    parser.add_argument("--api-drop-rate", type=float, default=apiDropRate, help="Share of API calls that fail with a connection error.")
+    parser.add_argument("--api-page-size", type=int, default=apiPageSize, help="Most workbooks the workbooks API returns per page.")
+    parser.add_argument("--api-etags", action="store_true", help="Send ETags from the profile API and answer matching requests with 304.")
+    parser.add_argument("--sheets-latency", type=float, default=sheetsLatency, help="Mean Google Sheets latency, in ms.")
+    parser.add_argument("--sheets-error-rate", type=float, default=sheetsErrorRate, help="Share of Sheets calls that fail with a quota error.")
+    parser.add_argument("--sheets-per-minute", type=int, default=sheetsPerMinute, help="Sheets quota, per minute, for reads and for writes.")
+    parser.add_argument("--max-runtime", type=int, default=Stats.maxRuntime, help="Stats maxRuntime, in seconds, to exercise resuming.")
+    parser.add_argument("--churn", type=float, default=churnRate, help="Share of workbooks that change between passes.")
+    parser.add_argument("--save", help="Save the results as JSON to this file.")
+    parser.add_argument("--compare", help="Compare the results with a JSON file saved by --save.")
+    parser.add_argument("--tolerance", type=float, default=compareTolerance, help="Percent change allowed before --compare reports a regression.")
+    parser.add_argument("--verbose", action="store_true", help="Show the log output of Stats and Summarize.")
+    args = parser.parse_args()
+
+    apiLatency = args.api_latency
+    apiErrorRate = args.api_error_rate
+    apiErrorStatus = args.api_error_status
+    apiDropRate = args.api_drop_rate
+    apiPageSize = args.api_page_size
+    apiEtags = args.api_etags
+    sheetsLatency = args.sheets_latency
+    sheetsErrorRate = args.sheets_error_rate
+    sheetsPerMinute = args.sheets_per_minute
+    churnRate = args.churn
+    Stats.maxRuntime = args.max_runtime
+
+    tracemalloc.start()
+    results = {}
+
+    for name in args.scenarios:
+        if name in scenarios:
+            profileCount = scenarios[name]["profiles"]
+            workbookCount = scenarios[name]["workbooks"]
+        else:
+            profileCount, workbookCount = [int(n) for n in name.lower().split("x")]
+
+        results[name] = run_scenario(name, profileCount, workbookCount, args.passes, args.verbose)
+
+    tracemalloc.stop()
+    log ("Max RSS: " + str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)) + " MB.")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = compare_results(results, baseline, args.tolerance)
+        log (str(regressions) + " regressions found.")
+
+        if regressions > 0:
+            sys.exit(1)
@@ -10,23 +10,197 @@ import requests
 import datetime
 import gspread
 import time
+import random
+import heapq
+import hashlib
+import sqlite3
+import os
+import io
+import csv
+import gzip
 import boto3
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from oauth2client.service_account import ServiceAccountCredentials
 from botocore.exceptions import ClientError
+from contextlib import contextmanager
 
 # Max runtime, in seconds, before exiting the program to avoid exceeding lambda max runtimes (900 seconds)
 maxRuntime = 780 
 
+# Profiles are refreshed once this many hours have passed since their last refresh. Any profile that has waited maxWaitHours
+# jumps ahead of the rest of the queue, including new sign-ups.
+refreshHours = 23
+maxWaitHours = 48
+
+# Number of profiles to refresh in parallel.
+profileWorkers = 4
+
+# Number of single_workbook detail calls to run in parallel for each page of workbooks.
+detailWorkers = 8
+
+# Tableau Public API settings. Calls that fail with one of the retry statuses (or a connection error) are retried with
+# jittered exponential backoff, honoring the Retry-After header when the server sends one.
+apiRetries = 4                                                          # Number of times to retry a failed API call.
+apiBackoff = 1                                                          # Base delay, in seconds, for the backoff.
+apiMaxBackoff = 30                                                      # Longest delay, in seconds, between retries.
+apiTimeout = 30                                                         # Timeout, in seconds, for each API call.
+apiRetryStatuses = [429, 500, 502, 503, 504]
+
+# When refreshing an existing stats sheet, read what's there first and only write the cells that changed.
+diffWrites = True
+
+# Sign-up sheet changes (new stats URLs, refresh dates) are queued and written in batches, once this many are waiting or this
+# many seconds have passed, and always before the program ends.
+signupFlushSize = 50
+signupFlushSeconds = 60
+
+# Google Sheets API quotas, per minute for our service account. Every Sheets call waits for a token from the matching bucket.
+# When a call still comes back with a quota error (429), the bucket slows down and the call is retried up to sheetsRetries times.
+sheetsReadsPerMinute = 60
+sheetsWritesPerMinute = 60
+sheetsRetries = 5
+
+# CloudWatch namespace for the metrics written at the end of each run, and the upper bounds (ms) of the latency histogram buckets.
+# Embedded Metric Format allows at most metricsPerDirective metrics in each CloudWatchMetrics directive.
+metricsNamespace = "TableauPublicStats"
+metricsBuckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+metricsPerDirective = 100
+
+# Refresh the Google access token before a run if it expires within this many seconds, so it lasts the whole run. The
+# credentials file is read from S3 again once the cached copy is credsMaxAgeHours old.
+tokenRefreshSeconds = 900
+credsMaxAgeHours = 12
+
+# Errors are collected and emailed as one digest at the end of the run, or as soon as errorDigestSize are waiting. The digest
+# groups them by type and endpoint, with up to errorDigestSamples example messages for each group.
+errorDigestSize = 100
+errorDigestSamples = 5
+
+# Workbook detail cache. Entries are dropped when not used for detailCacheMaxAge days, then the least recently used are dropped
+# to keep the cache under detailCacheMaxEntries.
+detailCacheMaxAge = 14
+detailCacheMaxEntries = 100000
+
+# Workbook detail fields that only change when the workbook is republished, and the counters that change all the time. Profile
+# visibility can be toggled without republishing, so the cached value is replaced by the list entry's, when it has one.
+detailStaticFields = ['title', 'description', 'defaultViewRepoUrl', 'defaultViewName', 'showInProfile', 'permalink', 'firstPublishDate', 'lastPublishDate', 'revision', 'size']
+detailVolatileFields = ['viewCount', 'numberOfFavorites']
+detailListFields = ['showInProfile']
+
+# Workbooks API page size. Pages start out asking for workbookPageMax workbooks, and drop to what the API actually returns
+# (or workbookPageMin, if it refuses the size) the first time it returns less.
+workbookPageMax = 500
+workbookPageMin = 50
+
+# Workbook history. Every refresh saves each workbook's views and favorites for the day, and the history is kept for historyDays.
+# The summary store gets the views and favorites each profile gained over the last historyDeltaDays.
+historyDays = 35
+historyDeltaDays = 7
+
+# Profiles that fail to refresh (profile API, workbooks API or opening the stats sheet) wait failureBackoffHours before they're
+# tried again, doubling with each failure in a row. After quarantineFailures failures in a row, a profile is quarantined and only
+# tried again every quarantineHours. Stats sheet failures are kept by stats URL, so they only hold back that sign-up row.
+failureBackoffHours = 6
+quarantineFailures = 5
+quarantineHours = 168
+
+# Where the stats rows go. "sheets" writes each profile's stats sheet. Add "export" to also write each profile's rows as one
+# compressed file under exportLocation, in exportFormat: "parquet" (if pyarrow is installed) or "csv" (gzip).
+outputSinks = ["sheets"]
+exportFormat = "parquet"
+
 # Other Variables
 urlProfileWB = 'https://public.tableau.com/public/apis/workbooks'
 
+# Column headings for the stats sheet. Each workbook row holds its values in the same order.
+statsHeader = [
+    "Viz - ID",
+    "Viz - Title",
+    "Viz - Description",
+    "Viz - URL",
+    "Viz - URL (No Home)",
+    "Viz - Thumbnail URL",
+    "Viz - Default View",
+    "Viz - Visible",
+    "Viz - Permalink",
+    "Viz - Views",
+    "Viz - Favorites",
+    "Viz - First Published",
+    "Viz - Last Published",
+    "Viz - Revision",
+    "Viz - Size",
+    "User - Name",
+    "User - Profile ID",
+    "User - Organization",
+    "User - Bio",
+    "User - Avatar URL",
+    "User - Searchable",
+    "User - Featured Viz",
+    "User - Last Published",
+    "User - Follower Count",
+    "User - Following Count",
+    "User - Country",
+    "User - State or Region",
+    "User - City",
+    "User - Website",
+    "User - LinkedIn",
+    "User - Twitter",
+    "User - Facebook",
+    "User - Tableau Public",
+    "Stats - Stats Last Refreshed",
+]
+
 # Fill in the following values with your own information.
 senderAddress = "Sender Name <email address>"                           # From name/email address for emails.
 ownerAddress = "email address"                                          # From email address for emails.
 s3Bucket = "bucket name"                                                # Name of the S3 bucket containing the credentials file.
 credsFile = "creds file name"                                           # Name of the credentials file in the S3 bucket.
+cursorFile = "stats-cursor.json"                                        # Name of the run cursor file in the S3 bucket.
+detailCacheFile = "stats-workbook-cache.json"                           # Name of the workbook detail cache file in the S3 bucket.
+profileCacheFile = "stats-profile-cache.json"                           # Name of the profile API cache file in the S3 bucket.
+summaryFile = "stats-summary.json"                                      # Name of the summary store file in the S3 bucket.
+sheetIndexFile = "stats-sheet-index.json"                               # Name of the stats sheet index file in the S3 bucket.
+failureFile = "stats-failures.json"                                     # Name of the profile failure ledger file in the S3 bucket.
+historyFile = "stats-history.db"                                        # Name of the workbook history database in the S3 bucket.
+historyPath = "/tmp/stats-history.db"                                   # Local copy of the workbook history database.
+exportLocation = "s3://bucket name/exports"                             # Where the export sink writes: s3://bucket/prefix or a local directory.
 worksheetID = "Worksheet ID"                                            # ID of the Sign-Up Google Sheet.
 
+# Per-thread state for the profile workers.
+workerState = threading.local()
+
+# Guard the workbook detail and profile caches and the stats sheet index, which are shared by all of the workers.
+detailCacheLock = threading.Lock()
+profileCacheLock = threading.Lock()
+sheetIndexLock = threading.Lock()
+
+# Clients and credentials, kept between invocations while the Lambda container stays warm.
+clientCache = {}
+clientCacheLock = threading.Lock()
+
+# Errors waiting for the next digest email.
+errorDigest = []
+errorDigestLock = threading.Lock()
+
+# Welcome emails waiting for the background sender.
+emailQueue = queue.Queue()
+emailLock = threading.Lock()
+emailSender = None
+
+# Shared HTTP session for the Tableau Public API, so connections to public.tableau.com are pooled and kept alive.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=profileWorkers*(detailWorkers+1)))
+
+# Page size for the workbooks API, lowered at runtime if the API accepts less than workbookPageMax.
+workbookPageSize = workbookPageMax
+
+# ETag of the copy of the history database in S3 that the local copy matches, so a warm container doesn't download it again.
+historyETag = None
+
 
 #------------------------------------------------------------------------------------------------------------------------------
 # Email new user
@@ -66,8 +240,8 @@ def send_new_user_email (email, firstName, url):
     # The character encoding for the email.
     charSet = "UTF-8"
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=region)
+    # Get the SES client for the region.
+    client = get_aws_client('ses', region)
 
     # Try to send the email.
     try:
@@ -120,7 +294,7 @@ def phone_home (subject, msg):
     <html>
     <head></head>
     <body>
-    <p style="font-family:Georgia;font-size:15px">""" + msg + """</p>
+    <p style="font-family:Georgia;font-size:15px">""" + msg.replace("\r\n", "<br>") + """</p>
     </body>
     </html>
     """            
@@ -128,8 +302,8 @@ def phone_home (subject, msg):
     # The character encoding for the email.
     charSet = "UTF-8"
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=region)
+    # Get the SES client for the region.
+    client = get_aws_client('ses', region)
 
     # Try to send the email.
     try:
@@ -179,456 +353,1882 @@ def end_function(msg=''):
     exit()
 
 #------------------------------------------------------------------------------------------------------------------------------
-# Main lambda handler
+# Record an error for the digest email. Errors are grouped by type (the subject), the endpoint that failed and the exception.
+# The digest goes out straight away once errorDigestSize errors are waiting.
 #------------------------------------------------------------------------------------------------------------------------------
-def lambda_handler(event, context):
-    # Get the start time so we can end the program before exceeding lambda max runtimes (900 seconds)
-    startTime = datetime.datetime.now()
+def report_error (subject, endpoint, msg, error=None):
+    errorType = ""
+    if error is not None:
+        errorType = type(error).__name__
 
-    # Get the Google Sheets credentials from S3
-    s3 = boto3.client('s3')
-    key = credsFile
-    object = s3.get_object(Bucket=s3Bucket, Key=key)
-    content = object['Body']
-    creds = json.loads(content.read())
+    with errorDigestLock:
+        errorDigest.append({"subject": subject, "endpoint": endpoint, "type": errorType, "msg": msg})
+        full = len(errorDigest) >= errorDigestSize
 
-    # Read the Google API key from the creds file.
-    scope =['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
-    gc = gspread.authorize(credentials) 
+    count_metric("ErrorsReported")
 
-    # Read the sign-up sheet
-    docProfiles = gc.open_by_url('https://docs.google.com/spreadsheets/d/' + worksheetID)
-    sheetProfiles = docProfiles.get_worksheet(0)
+    if full:
+        send_error_digest()
 
-    emailList = sheetProfiles.col_values(2)
-    firstnameList = sheetProfiles.col_values(3)
-    lastnameList = sheetProfiles.col_values(4)
-    profileList = sheetProfiles.col_values(5)
-    urlList = sheetProfiles.col_values(6)
-    dateList = sheetProfiles.col_values(7)
-    profileCount = len(emailList)
+#------------------------------------------------------------------------------------------------------------------------------
+# Email the waiting errors as one digest, largest group first.
+#------------------------------------------------------------------------------------------------------------------------------
+def send_error_digest ():
+    with errorDigestLock:
+        errors = list(errorDigest)
+        errorDigest.clear()
 
-    # Initialize some variables.
-    processed = False
-    newCount = 0
+    if len(errors) == 0:
+        return
+
+    groups = {}
+    for error in errors:
+        groups.setdefault((error["subject"], error["endpoint"], error["type"]), []).append(error["msg"])
+
+    lines = [str(len(errors)) + " errors were reported."]
+
+    for (subject, endpoint, errorType), messages in sorted(groups.items(), key=lambda group: -len(group[1])):
+        heading = subject + " - " + endpoint
+        if errorType != "":
+            heading += " (" + errorType + ")"
+
+        lines.append("")
+        lines.append(heading + ": " + str(len(messages)) + " errors")
+
+        for msg in messages[0:errorDigestSamples]:
+            lines.append("    " + msg)
+
+        if len(messages) > errorDigestSamples:
+            lines.append("    ... and " + str(len(messages) - errorDigestSamples) + " more.")
+
+    subject = "Tableau Public Stats Service" + " - " + str(len(errors)) + " Errors"
+    phone_home(subject, "\r\n".join(lines))
+    count_metric("ErrorDigestsSent")
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Queue a welcome email for the background sender, starting the sender if it isn't running, so the main thread never waits
+# on SES.
+#------------------------------------------------------------------------------------------------------------------------------
+def queue_new_user_email (email, firstName, url):
+    global emailSender
+
+    with emailLock:
+        if emailSender is None or not emailSender.is_alive():
+            emailSender = threading.Thread(target=send_queued_emails, daemon=True)
+            emailSender.start()
+
+    emailQueue.put((email, firstName, url))
+    count_metric("WelcomeEmailsQueued")
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Background sender: send the queued welcome emails, one at a time.
+#------------------------------------------------------------------------------------------------------------------------------
+def send_queued_emails ():
+    while True:
+        email, firstName, url = emailQueue.get()
+
+        try:
+            send_new_user_email(email, firstName, url)
+        except Exception as e:
+            log ("Unable to send the welcome email to " + email + ": " + str(e))
+        finally:
+            emailQueue.task_done()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Wait for the queued welcome emails to go out. Call before the handler returns, as Lambda freezes the sender afterwards.
+#------------------------------------------------------------------------------------------------------------------------------
+def wait_for_emails ():
+    emailQueue.join()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the boto3 client for an AWS service. Clients are created on first use and reused for the life of the container, so a
+# run that sends no email never sets up SES.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_aws_client (service, region=None):
+    with clientCacheLock:
+        if service not in clientCache:
+            if region is None:
+                clientCache[service] = boto3.client(service)
+            else:
+                clientCache[service] = boto3.client(service, region_name=region)
+
+        return clientCache[service]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the Google Sheets client. The credentials file is read from S3 and authorized on a cold start (or once the cached copy
+# is credsMaxAgeHours old), then reused. The access token is only refreshed when it's close to expiring.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_sheets_client ():
+    s3 = get_aws_client('s3')
+
+    with clientCacheLock:
+        loaded = clientCache.get("credsLoaded")
+
+        if loaded is None or datetime.datetime.now() - loaded >= datetime.timedelta(hours=credsMaxAgeHours):
+            object = s3.get_object(Bucket=s3Bucket, Key=credsFile)
+            creds = json.loads(object['Body'].read())
+
+            # Read the Google API key from the creds file.
+            scope =['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
+            clientCache["gc"] = gspread.authorize(credentials)
+            clientCache["credsLoaded"] = datetime.datetime.now()
+            count_metric("CredentialsLoaded")
+
+        gc = clientCache["gc"]
+
+        # gspread 6 keeps the credentials (and login) on the client's HTTP client, rather than on the client itself.
+        httpClient = getattr(gc, "http_client", gc)
+
+        # The token's expiry is kept in UTC, without a time zone.
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if httpClient.auth.token is None or httpClient.auth.expiry is None or httpClient.auth.expiry - now < datetime.timedelta(seconds=tokenRefreshSeconds):
+            httpClient.login()
+            count_metric("TokenRefreshes")
+
+    return gc
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Token bucket used to pace Google Sheets calls. Tokens refill at the bucket's rate, up to a few seconds' worth for bursts.
+# Callers take a token and sleep until it has been earned, so waiting callers are served in order. The rate is cut in half
+# after a quota error and creeps back up to the configured rate as calls succeed. Counters record how the bucket was used.
+#------------------------------------------------------------------------------------------------------------------------------
+class TokenBucket:
+    def __init__ (self, perMinute):
+        self.maxRate = perMinute / 60
+        self.rate = self.maxRate
+        self.capacity = max(1, perMinute / 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters (self):
+        self.calls = 0
+        self.waited = 0.0
+        self.throttled = 0
+
+    def acquire (self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+
+            self.calls += 1
+            self.waited += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle (self):
+        with self.lock:
+            self.rate = max(self.maxRate / 8, self.rate / 2)
+            self.throttled += 1
+
+    def recover (self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 20)
+
+# Buckets shared by every Google Sheets call.
+sheetsReads = TokenBucket(sheetsReadsPerMinute)
+sheetsWrites = TokenBucket(sheetsWritesPerMinute)
+
+# Timings (ms, by phase) and counters for the current run, written out by emit_metrics.
+metricsLock = threading.Lock()
+metricTimings = {}
+metricCounts = {}
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Check whether an exception is the Google API telling us we've exceeded a quota.
+#------------------------------------------------------------------------------------------------------------------------------
+def is_quota_error (e):
+    return isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 429
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Make a Google Sheets call once the bucket allows it, retrying with backoff when a quota error comes back.
+#------------------------------------------------------------------------------------------------------------------------------
+def sheets_call (bucket, function, *args, **kwargs):
+    for attempt in range(0, sheetsRetries+1):
+        bucket.acquire()
+
+        try:
+            result = function(*args, **kwargs)
 
-    # Loop through all the profiles.
-    for i in range(1, profileCount):
-        continueLoop = True
+        except gspread.exceptions.APIError as e:
+            if not is_quota_error(e) or attempt == sheetsRetries:
+                raise
 
-        # Check time so we can end the program before exceeding lambda max runtimes (900 seconds)
-        checkTime = datetime.datetime.now()
-        dateDiff = checkTime - startTime
-        secondsRunning = dateDiff.seconds
+            bucket.throttle()
 
-        if secondsRunning >= maxRuntime:
-            end_function("Program exceeded max runtime and was forced to end.")
+            delay = random.uniform(1, min(60, 2 ** (attempt + 2)))
+            log ("Google API quota exceeded. Pausing for " + str(round(delay, 1)) + " seconds...")
+            time.sleep(delay)
+
+        else:
+            bucket.recover()
+            return result
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Make a Google Sheets read or write call, paced by the matching bucket.
+#------------------------------------------------------------------------------------------------------------------------------
+def sheets_read (function, *args, **kwargs):
+    return sheets_call(sheetsReads, function, *args, **kwargs)
+
+def sheets_write (function, *args, **kwargs):
+    return sheets_call(sheetsWrites, function, *args, **kwargs)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Clear the metrics at the start of a run. The buckets are module level, so their counters are cleared as well.
+#------------------------------------------------------------------------------------------------------------------------------
+def reset_metrics ():
+    with metricsLock:
+        metricTimings.clear()
+        metricCounts.clear()
 
-        refreshDateStr = ''
+    sheetsReads.reset_counters()
+    sheetsWrites.reset_counters()
 
-        # Get the last refresh date.
-        if len(dateList) <= i:
-            # No value. Set way back.
-            refreshDateStr = "2000-01-01 00:00:00"
-        elif urlList[i] == "":
-            # Blank. Set way back.
-            refreshDateStr = "2000-01-01 00:00:00"
+#------------------------------------------------------------------------------------------------------------------------------
+# Add to one of the run's counters (calls, retries, bytes, rows, etc.)
+#------------------------------------------------------------------------------------------------------------------------------
+def count_metric (name, value=1):
+    with metricsLock:
+        metricCounts[name] = metricCounts.get(name, 0) + value
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Time a phase of the run. Use as: with timed("Phase"): ...
+#------------------------------------------------------------------------------------------------------------------------------
+@contextmanager
+def timed (phase):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        milliseconds = (time.perf_counter() - start) * 1000
+
+        with metricsLock:
+            metricTimings.setdefault(phase, []).append(milliseconds)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get a percentile from a sorted list of timings.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_percentile (timings, percent):
+    return timings[min(len(timings)-1, int(len(timings) * percent / 100))]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write the run's metrics. CloudWatch picks up the JSON line as Embedded Metric Format: each phase gets a call count and latency
+# percentiles (ms), plus a latency histogram as a plain property. A readable summary is also logged for local runs.
+#------------------------------------------------------------------------------------------------------------------------------
+def emit_metrics (functionName):
+    with metricsLock:
+        timings = {phase: sorted(values) for phase, values in metricTimings.items()}
+        counts = dict(metricCounts)
+
+    counts["SheetsReadCalls"] = sheetsReads.calls
+    counts["SheetsReadWaitSeconds"] = round(sheetsReads.waited, 3)
+    counts["SheetsWriteCalls"] = sheetsWrites.calls
+    counts["SheetsWriteWaitSeconds"] = round(sheetsWrites.waited, 3)
+    counts["SheetsQuotaErrors"] = sheetsReads.throttled + sheetsWrites.throttled
+
+    record = {"Function": functionName, "Histograms": {}}
+    definitions = []
+
+    for phase, values in timings.items():
+        record[phase + "Count"] = len(values)
+        record[phase + "P50"] = round(get_percentile(values, 50), 1)
+        record[phase + "P90"] = round(get_percentile(values, 90), 1)
+        record[phase + "P99"] = round(get_percentile(values, 99), 1)
+        record[phase + "Max"] = round(values[-1], 1)
+        record[phase + "Total"] = round(sum(values), 1)
+
+        definitions.append({"Name": phase + "Count", "Unit": "Count"})
+        for stat in ["P50", "P90", "P99", "Max", "Total"]:
+            definitions.append({"Name": phase + stat, "Unit": "Milliseconds"})
+
+        # Histogram of latencies in ms, by upper bound of each bucket.
+        histogram = {}
+        for value in values:
+            bucket = next((str(bound) for bound in metricsBuckets if value < bound), "More")
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        record["Histograms"][phase] = histogram
+
+        log ("Metrics - " + phase + ": " + str(len(values)) + " calls, p50 " + str(record[phase + "P50"]) + " ms, p90 " + str(record[phase + "P90"]) + " ms, max " + str(record[phase + "Max"]) + " ms, total " + str(round(sum(values)/1000, 1)) + " s.")
+
+    for name, value in counts.items():
+        record[name] = value
+
+        if name.endswith("Seconds"):
+            definitions.append({"Name": name, "Unit": "Seconds"})
+        elif name.endswith("Bytes"):
+            definitions.append({"Name": name, "Unit": "Bytes"})
         else:
-            # Use the value.
-            refreshDateStr = dateList[i]
-
-        # If still blank, set back.
-        if refreshDateStr == '':
-            refreshDateStr = "2000-01-01 00:00:00"
-
-        refreshDate = datetime.datetime.strptime(refreshDateStr, "%Y-%m-%d %H:%M:%S")
-        dateDiff = datetime.datetime.now() - refreshDate
-        hoursSinceRefresh = dateDiff.total_seconds()/3600
-
-        if hoursSinceRefresh >= 23:
-            # Get profile URL and and change it to use the API url.
-            profileID = profileList[i]
-            urlProfile = "https://public.tableau.com/profile/" + profileID + "#!/"
-            urlProfileOriginal = urlProfile
-            urlProfile = urlProfile.strip()
-            urlProfile = urlProfile[0:len(urlProfile)-3]
-            urlProfile = urlProfile + "/"
-            urlProfile = urlProfile.replace('https://public.tableau.com/profile', 'https://public.tableau.com/profile/api')
-
-            # Remove trailing slash if present
-            if urlProfile.endswith("/"):
-                urlProfile = urlProfile[:-1]
-
-            log ("Processing profile: " + lastnameList[i] + ", " + firstnameList[i])
-
-            if len(urlList) <= i:
-                # No value.
-                processed = False
-            elif urlList[i] == "":
-                # Blank means this hasn't been processed. 
-                processed = False
+            definitions.append({"Name": name, "Unit": "Count"})
+
+        log ("Metrics - " + name + ": " + str(value))
+
+    # Split the definitions across directives, so CloudWatch doesn't reject the whole record once there are too many phases.
+    directives = []
+    for i in range(0, len(definitions), metricsPerDirective):
+        directives.append({"Namespace": metricsNamespace, "Dimensions": [["Function"]], "Metrics": definitions[i:i+metricsPerDirective]})
+
+    record["_aws"] = {"Timestamp": int(time.time() * 1000), "CloudWatchMetrics": directives}
+    print(json.dumps(record))
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Read a JSON state file from the S3 bucket. Returns the default if the file does not exist yet.
+#------------------------------------------------------------------------------------------------------------------------------
+def load_state (s3, key, default):
+    try:
+        object = s3.get_object(Bucket=s3Bucket, Key=key)
+
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return default
+        raise
+
+    return json.loads(object['Body'].read())
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write a JSON state file to the S3 bucket.
+#------------------------------------------------------------------------------------------------------------------------------
+def save_state (s3, key, state):
+    s3.put_object(Bucket=s3Bucket, Key=key, Body=json.dumps(state).encode("utf-8"))
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Open the workbook history database, downloading it from the S3 bucket unless the local copy (from the last invocation in this
+# container) is already up to date.
+#------------------------------------------------------------------------------------------------------------------------------
+def open_history (s3):
+    global historyETag
+
+    try:
+        etag = s3.head_object(Bucket=s3Bucket, Key=historyFile)['ETag']
+
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', 'NotFound', '404']:
+            etag = None
+        else:
+            raise
+
+    if etag != historyETag or os.path.exists(historyPath) == False:
+        if os.path.exists(historyPath):
+            os.remove(historyPath)
+
+        if etag is not None:
+            with timed("DownloadHistory"):
+                s3.download_file(s3Bucket, historyFile, historyPath)
+
+        historyETag = etag
+
+    db = sqlite3.connect(historyPath)
+    db.execute("CREATE TABLE IF NOT EXISTS history (profile TEXT NOT NULL, workbook TEXT NOT NULL, date TEXT NOT NULL, views INTEGER NOT NULL, favorites INTEGER NOT NULL, PRIMARY KEY (profile, workbook, date)) WITHOUT ROWID")
+    return db
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop history older than historyDays, then upload the database to the S3 bucket.
+#------------------------------------------------------------------------------------------------------------------------------
+def save_history (s3, db):
+    global historyETag
+
+    oldest = (datetime.date.today() - datetime.timedelta(days=historyDays)).isoformat()
+    db.execute("DELETE FROM history WHERE date < ?", (oldest,))
+    db.commit()
+    db.close()
+
+    with timed("UploadHistory"):
+        s3.upload_file(historyPath, s3Bucket, historyFile)
+
+    historyETag = s3.head_object(Bucket=s3Bucket, Key=historyFile)['ETag']
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Save today's views and favorites for each of a profile's workbooks. A second refresh on the same day replaces the first.
+#------------------------------------------------------------------------------------------------------------------------------
+def record_history (db, profileID, history):
+    date = datetime.date.today().isoformat()
+    db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?)", [(profileID, workbook, date, views, favorites) for workbook, views, favorites in history])
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the views and favorites a profile gained over the last number of days, from its oldest saved day in that window to its
+# latest.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_history_delta (db, profileID, days):
+    oldest = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+    totals = db.execute("SELECT date, SUM(views), SUM(favorites) FROM history WHERE profile = ? AND date >= ? GROUP BY date ORDER BY date", (profileID, oldest)).fetchall()
+
+    if len(totals) == 0:
+        return 0, 0
+
+    return totals[-1][1] - totals[0][1], totals[-1][2] - totals[0][2]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build an export file from a header and rows: Parquet, or gzip CSV if pyarrow isn't installed or exportFormat is "csv". Returns
+# the file (ready to read) and its extension.
+#------------------------------------------------------------------------------------------------------------------------------
+def build_export (header, rows):
+    buffer = io.BytesIO()
+
+    # pyarrow is optional, and only imported here so runs without the export sink don't pay for loading it.
+    pyarrow = None
+    if exportFormat == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            pass
+
+    if pyarrow is not None:
+        columns = []
+
+        for c in range(0, len(header)):
+            values = [None if row[c] == '' else row[c] for row in rows]
+
+            try:
+                columns.append(pyarrow.array(values))
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                # Mixed types, so store the column as text.
+                columns.append(pyarrow.array([None if value is None else str(value) for value in values]))
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(columns, names=header), buffer, compression="snappy")
+        extension = ".parquet"
+
+    else:
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as zipped:
+            with io.TextIOWrapper(zipped, encoding="utf-8", newline="") as text:
+                writer = csv.writer(text)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+        extension = ".csv.gz"
+
+    buffer.seek(0)
+    return buffer, extension
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write a header and rows to exportLocation as one file, replacing the last export with the same name.
+#------------------------------------------------------------------------------------------------------------------------------
+def write_export (name, header, rows):
+    buffer, extension = build_export(header, rows)
+
+    with timed("WriteExport"):
+        if exportLocation.startswith("s3://"):
+            bucket, _, prefix = exportLocation[5:].partition("/")
+            key = (prefix.rstrip("/") + "/" if prefix != "" else "") + name + extension
+            get_aws_client('s3').upload_fileobj(buffer, bucket, key)
+
+        else:
+            path = os.path.join(exportLocation, name + extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, "wb") as f:
+                f.write(buffer.getvalue())
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the number of seconds the server asked us to wait via the Retry-After header (seconds or an HTTP date), if any.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_retry_after (response):
+    retryAfter = response.headers.get("Retry-After", "")
+
+    if retryAfter == "":
+        return None
+
+    try:
+        return max(0, float(retryAfter))
+    except ValueError:
+        pass
+
+    try:
+        retryDate = parsedate_to_datetime(retryAfter)
+        return max(0, (retryDate - datetime.datetime.now(retryDate.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Call the Tableau Public API through the shared session, retrying throttled (429), failed (5xx) and dropped calls.
+#------------------------------------------------------------------------------------------------------------------------------
+def api_get (url, params=None, headers=None):
+    for attempt in range(0, apiRetries+1):
+        # Full jitter: wait a random time up to the exponential backoff for this attempt.
+        delay = random.uniform(0, min(apiMaxBackoff, apiBackoff * 2**attempt))
+
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=apiTimeout)
+            count_metric("ApiCalls")
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == apiRetries:
+                raise
+
+            count_metric("ApiRetries")
+
+        else:
+            count_metric("ApiBytes", len(response.content))
+
+            if response.status_code not in apiRetryStatuses or attempt == apiRetries:
+                return response
+
+            count_metric("ApiRetries")
+
+            retryAfter = get_retry_after(response)
+            if retryAfter is not None:
+                delay = min(apiMaxBackoff, retryAfter)
+
+            log ("API call returned " + str(response.status_code) + ", retrying in " + str(round(delay, 1)) + " seconds: " + url)
+
+        time.sleep(delay)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Call the Workbook Detail API for a single workbook.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_workbook_detail (workbookID):
+    urlWorkbook = "https://public.tableau.com/profile/api/single_workbook/" + workbookID + "?"
+    with timed("WorkbookDetailApi"):
+        response = api_get(urlWorkbook)
+
+    return response.json()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get a workbook's details from the cache, using the entry from the workbooks list API. The cached entry is only used when the
+# list shows the same revision and last publish date, and already includes the counters (and visibility), so nothing needs to
+# be fetched. Returns None if the single_workbook API needs to be called.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_cached_detail (detailCache, workbook):
+    entry = detailCache.get(workbook['workbookRepoUrl'])
+
+    if entry is None:
+        return None
+
+    for field in ['revision', 'lastPublishDate'] + detailVolatileFields:
+        if field not in workbook:
+            return None
+
+    if workbook['revision'] != entry['revision'] or workbook['lastPublishDate'] != entry['lastPublishDate']:
+        return None
+
+    wbStats = dict(entry['detail'])
+    for field in detailVolatileFields:
+        wbStats[field] = workbook[field]
+
+    for field in detailListFields:
+        if field in workbook:
+            wbStats[field] = workbook[field]
+
+    entry['used'] = datetime.date.today().isoformat()
+    return wbStats
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Store the static fields of a workbook's details in the cache.
+#------------------------------------------------------------------------------------------------------------------------------
+def put_cached_detail (detailCache, workbookID, wbStats):
+    entry = {}
+    entry['revision'] = wbStats['revision']
+    entry['lastPublishDate'] = wbStats['lastPublishDate']
+    entry['detail'] = {field: wbStats[field] for field in detailStaticFields}
+    entry['used'] = datetime.date.today().isoformat()
+
+    with detailCacheLock:
+        detailCache[workbookID] = entry
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop old entries from the workbook detail cache, then the least recently used if it's still too big.
+#------------------------------------------------------------------------------------------------------------------------------
+def evict_detail_cache (detailCache):
+    oldest = (datetime.date.today() - datetime.timedelta(days=detailCacheMaxAge)).isoformat()
+
+    with detailCacheLock:
+        for workbookID in [w for w, entry in detailCache.items() if entry['used'] < oldest]:
+            del detailCache[workbookID]
+
+        if len(detailCache) > detailCacheMaxEntries:
+            byUse = sorted(detailCache, key=lambda w: detailCache[w]['used'])
+            for workbookID in byUse[0:len(detailCache)-detailCacheMaxEntries]:
+                del detailCache[workbookID]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the details for a page of workbooks. Unchanged workbooks come from the cache; the rest are fetched from the Workbook
+# Detail API in parallel. Results are returned in the same order as the page.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_workbook_details (workbooks, detailCache):
+    workbookDetails = [get_cached_detail(detailCache, workbook) for workbook in workbooks]
+    fetchIDs = [workbook['workbookRepoUrl'] for workbook, wbStats in zip(workbooks, workbookDetails) if wbStats is None]
+
+    with ThreadPoolExecutor(max_workers=detailWorkers) as executor:
+        fetched = dict(zip(fetchIDs, executor.map(get_workbook_detail, fetchIDs)))
+
+    count_metric("DetailCacheHits", len(workbooks) - len(fetchIDs))
+
+    for n, workbook in enumerate(workbooks):
+        workbookID = workbook['workbookRepoUrl']
+
+        if workbookID in fetched:
+            workbookDetails[n] = fetched[workbookID]
+            put_cached_detail(detailCache, workbookID, fetched[workbookID])
+
+    return workbookDetails
+
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Call the workbooks API for one page of a profile's workbooks, asking for as many as workbookPageSize (or pageSize, if given).
+# If the API refuses the size, or moves the next page on by fewer workbooks than we asked for, the size is lowered to what it
+# accepts and kept for the rest of the container's life. (A page can hold fewer workbooks than that, since hidden workbooks are
+# left out, so the count returned isn't used.) A refused size is only lowered once a page of workbookPageMin succeeds, since
+# the request may have been refused for another reason (such as a bad profile).
+#------------------------------------------------------------------------------------------------------------------------------
+def get_workbook_page (profileID, start, pageSize=None):
+    global workbookPageSize
+
+    if pageSize is None:
+        pageSize = workbookPageSize
+
+    parameters = {"count": pageSize, "start": start, "profileName": profileID, "visibility": "NON_HIDDEN"}
+
+    with timed("WorkbookPageApi"):
+        response = api_get(urlProfileWB, params=parameters)
+
+    if response.status_code in [400, 413, 422] and pageSize > workbookPageMin:
+        log ("Workbooks API refused a page size of " + str(pageSize) + ", trying " + str(workbookPageMin) + ".")
+        output = get_workbook_page(profileID, start, workbookPageMin)
+
+        log ("Workbooks API accepted a page size of " + str(workbookPageMin) + ", using it from now on.")
+        workbookPageSize = min(workbookPageSize, workbookPageMin)
+        return output
+
+    response.raise_for_status()
+    output = response.json()
+    pageCount = output['next'] - start
+
+    if output['next'] != -1 and 0 < pageCount < pageSize and pageCount < workbookPageSize:
+        log ("Workbooks API returns at most " + str(pageCount) + " workbooks per page.")
+        workbookPageSize = pageCount
+
+    return output
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get where the page after this one starts. The API gives it as 'next' (-1 on the last page), which can be further on than the
+# number of workbooks the page holds.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_next_start (start, output):
+    if output['next'] == -1:
+        return start + len(output['contents'])
+
+    return output['next']
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Generate the pages of a profile's workbooks from the given start, as (start, output) pairs. While the caller processes
+# one page, the next is already being fetched. Close the generator if you stop early.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_workbook_pages (profileID, start):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(get_workbook_page, profileID, start)
+
+        while future is not None:
+            output = future.result()
+            nextStart = get_next_start(start, output)
+
+            if output['next'] == -1 or nextStart <= start:
+                future = None
             else:
-                # This has already been processed.
-                processed = True
+                future = executor.submit(get_workbook_page, profileID, nextStart)
+
+            yield start, output
+            start = nextStart
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Convert a value to the Sheets API cell format, keeping its type (as a RAW values update would).
+#------------------------------------------------------------------------------------------------------------------------------
+def get_cell_data (value):
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    elif isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    elif value is None:
+        return {}
+    else:
+        return {"userEnteredValue": {"stringValue": str(value)}}
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Check whether a value read back from a sheet (unformatted) is the same as the value we're about to write. Booleans are checked
+# separately since True == 1 in Python.
+#------------------------------------------------------------------------------------------------------------------------------
+def same_value (old, new):
+    return old == new and isinstance(old, bool) == isinstance(new, bool)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build the updateCells requests that change a sheet's previous values (A:AH, unformatted) into the new header and rows.
+# Each row's changed cells are grouped into runs of columns, and the same run on consecutive rows is sent as one block, so
+# columns that change on every row (views, favorites, refresh date) cost one request each. Rows that are no longer needed are
+# cleared. Returns the requests and the number of cells written.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_diff_updates (sheetId, previous, rows):
+    columnCount = len(statsHeader)
+    newRows = [statsHeader] + rows
+    blocks = {}
+    updates = []
+    cellCount = 0
+
+    for r, row in enumerate(newRows):
+        if r < len(previous):
+            oldRow = previous[r] + [''] * (columnCount - len(previous[r]))
+        else:
+            oldRow = [None] * columnCount
+
+        # Find the runs of changed columns in this row.
+        runs = []
+        for c in range(0, columnCount):
+            if not same_value(oldRow[c], row[c]):
+                if len(runs) > 0 and runs[-1][1] == c:
+                    runs[-1][1] = c + 1
+                else:
+                    runs.append([c, c + 1])
+
+        # Add each run to the block for the same columns on the row above, or start a new block.
+        for c0, c1 in runs:
+            block = blocks.get((c0, c1))
+
+            if block is None or block["lastRow"] != r - 1:
+                block = {"start": {"sheetId": sheetId, "rowIndex": r, "columnIndex": c0}, "rows": [], "lastRow": r}
+                blocks[c0, c1] = block
+                updates.append(block)
+
+            block["rows"].append({"values": [get_cell_data(value) for value in row[c0:c1]]})
+            block["lastRow"] = r
+            cellCount += c1 - c0
+
+    updates = [{"updateCells": {"start": block["start"], "rows": block["rows"], "fields": "userEnteredValue"}} for block in updates]
+
+    # Clear rows left over from the previous refresh.
+    if len(previous) > len(newRows):
+        extra = {"sheetId": sheetId, "startRowIndex": len(newRows), "endRowIndex": len(previous), "startColumnIndex": 0, "endColumnIndex": columnCount}
+        updates.append({"updateCells": {"range": extra, "fields": "userEnteredValue"}})
+        cellCount += (len(previous) - len(newRows)) * columnCount
+
+    return updates, cellCount
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write a profile's rows to its stats sheet. For an existing sheet, read the current values first so we only write what changed.
+#------------------------------------------------------------------------------------------------------------------------------
+def update_stats_sheet (sheetStats, rows, processed):
+    previous = None
+    if processed == True and diffWrites == True:
+        with timed("ReadStatsSheet"):
+            previous = sheets_read(sheetStats.get_values, "A:AH", value_render_option="UNFORMATTED_VALUE")
+
+    return write_stats_sheet(sheetStats, rows, previous)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write the header and workbook rows to a stats sheet with a single batchUpdate request. The same request clears any old values,
+# grows the grid if needed and applies the finishing touches (formatting, frozen header, title). The finishing touches cover
+# whole columns, so they're skipped when the sheet already has them.
+# If the sheet's previous values are passed in, only the cells that changed are written. Returns the worksheet properties the
+# request changed (title and grid), for the sheet index.
+#------------------------------------------------------------------------------------------------------------------------------
+def write_stats_sheet (sheetStats, rows, previous=None):
+    sheetId = sheetStats.id
+    rowCount = len(rows) + 1
+    columnCount = len(statsHeader)
+    updates = []
+    properties = {"gridProperties": {}}
+
+    # Make sure the grid is big enough.
+    if sheetStats.row_count < rowCount or sheetStats.col_count < columnCount:
+        grid = {"rowCount": max(sheetStats.row_count, rowCount), "columnCount": max(sheetStats.col_count, columnCount)}
+        properties["gridProperties"].update(grid)
+        updates.append({"updateSheetProperties": {"properties": {"sheetId": sheetId, "gridProperties": grid}, "fields": "gridProperties.rowCount,gridProperties.columnCount"}})
+
+    if previous is None:
+        # Write the header and rows from A1. Every other cell on the sheet is cleared.
+        cells = [{"values": [get_cell_data(value) for value in row]} for row in [statsHeader] + rows]
+        updates.append({"updateCells": {"range": {"sheetId": sheetId}, "rows": cells, "fields": "userEnteredValue"}})
+        count_metric("CellsWritten", rowCount * columnCount)
+    else:
+        # Only write the changes.
+        diffUpdates, cellCount = get_diff_updates(sheetId, previous, rows)
+        updates += diffUpdates
+        count_metric("CellsWritten", cellCount)
+        log ("Writing " + str(cellCount) + " changed cells of " + str(rowCount * columnCount) + ".")
+
+    if len(updates) == 0:
+        return properties
+
+    # Finishing touches
+    if sheetStats.title != "Stats" or sheetStats.frozen_row_count != 1:
+        columns = {"sheetId": sheetId, "startColumnIndex": 0, "endColumnIndex": columnCount}
+        header = {"sheetId": sheetId, "startRowIndex": 0, "endRowIndex": 1, "startColumnIndex": 0, "endColumnIndex": columnCount}
+
+        updates.append({"repeatCell": {"range": columns, "cell": {"userEnteredFormat": {"verticalAlignment": "TOP"}}, "fields": "userEnteredFormat.verticalAlignment"}})
+        updates.append({"repeatCell": {"range": header, "cell": {"userEnteredFormat": {"textFormat": {"bold": True}}}, "fields": "userEnteredFormat.textFormat.bold"}})
+        updates.append({"updateSheetProperties": {"properties": {"sheetId": sheetId, "title": "Stats", "gridProperties": {"frozenRowCount": 1}}, "fields": "title,gridProperties.frozenRowCount"}})
+        properties["title"] = "Stats"
+        properties["gridProperties"]["frozenRowCount"] = 1
+
+    body = {"requests": updates}
+
+    with timed("WriteStatsSheet"):
+        sheets_write(sheetStats.spreadsheet.batch_update, body)
+
+    count_metric("RowsWritten", len(rows))
+    count_metric("SheetsBytesWritten", len(json.dumps(body)))
+
+    return properties
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Total up a profile's rows for the Summary sheet: favorites, views and visible vizzes, plus the follower counts (the same on
+# every row). These are the numbers Summarize would otherwise read back from the stats sheet.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_summary_record (rows):
+    record = {}
+    record["favorites"] = sum(row[10] for row in rows if row[10] != '')
+    record["views"] = sum(row[9] for row in rows if row[9] != '')
+    record["followers"] = rows[0][23]
+    record["following"] = rows[0][24]
+    record["vizzes"] = len([row for row in rows if row[7] == True])
+    record["refreshed"] = rows[0][33]
+
+    return record
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the failure ledger key for a result. A failure on a row's stats sheet (or any other error outside the profile fetch) is
+# kept under the stats URL, so a broken sheet doesn't hold back the profile's other rows. Failures fetching the profile are
+# kept under the profile ID.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_failure_key (result):
+    if result["failure"] in ["Google Sheets", "Refresh"] and result["fetching"] == False and result["url"] != "":
+        return result["url"]
+
+    return result["profileID"]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Note a failed refresh in the failure ledger, under a profile ID or stats URL, and work out when to try it again:
+# failureBackoffHours, doubling with each failure in a row, or quarantineHours once it has failed quarantineFailures times in
+# a row.
+#------------------------------------------------------------------------------------------------------------------------------
+def record_failure (failureLedger, key, endpoint):
+    entry = failureLedger.get(key, {"failures": 0})
+    entry["failures"] += 1
+    entry["endpoint"] = endpoint
+    entry["lastFailure"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    if entry["failures"] >= quarantineFailures:
+        hours = quarantineHours
+
+        if entry["failures"] == quarantineFailures:
+            log ("Quarantining " + key + " after " + str(quarantineFailures) + " failures in a row (" + endpoint + ").")
+            count_metric("ProfilesQuarantined")
+    else:
+        hours = min(failureBackoffHours * 2 ** (entry["failures"] - 1), quarantineHours)
+
+    entry["retryAfter"] = (datetime.datetime.now() + datetime.timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+    failureLedger[key] = entry
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop ledger entries for profiles and stats sheets that are no longer on the sign-up sheet, then add the ledger's totals to the
+# run metrics.
+#------------------------------------------------------------------------------------------------------------------------------
+def evict_failure_ledger (failureLedger, keyList):
+    keys = set(keyList)
+
+    for key in [k for k in failureLedger if k not in keys]:
+        del failureLedger[key]
+
+    count_metric("LedgerFailing", len([entry for entry in failureLedger.values() if entry["failures"] < quarantineFailures]))
+    count_metric("LedgerQuarantined", len([entry for entry in failureLedger.values() if entry["failures"] >= quarantineFailures]))
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop summary records for stats sheets that are no longer on the sign-up sheet and haven't been refreshed for
+# detailCacheMaxAge days.
+#------------------------------------------------------------------------------------------------------------------------------
+def evict_summary_store (summaryStore, urlList):
+    oldest = (datetime.datetime.now() - datetime.timedelta(days=detailCacheMaxAge)).strftime("%Y-%m-%d %H:%M:%S")
+    urls = set(urlList)
+
+    for url in [u for u, record in summaryStore.items() if u not in urls and record["refreshed"] < oldest]:
+        del summaryStore[url]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the Google Sheets client for the current worker. Each worker thread keeps its own client, authorized with the main
+# client's credentials so the token is shared rather than fetched again.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_worker_client (credentials):
+    if not hasattr(workerState, "gc"):
+        workerState.gc = gspread.authorize(credentials)
+
+    return workerState.gc
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Parse the profile API output into the user columns of the stats sheet (User - Name through User - Tableau Public). The
+# User - Last Published column comes from the workbooks, so it's left blank here.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_user_columns (output, urlProfileOriginal):
+    userName = output["name"]
+
+    # Check for organization.
+    org_exists =  "organization" in output
+    if org_exists:
+        userOrg = output["organization"]
+    else:
+        userOrg = ""
+
+    # Check for bio.
+    bio_exists =  "bio" in output
+    if bio_exists:
+        bio = output["bio"]
+    else:
+        bio = ""
+    
+    # Get general information.
+    followerCount = output["totalNumberOfFollowers"]
+    totalNumberOfFollowing = output["totalNumberOfFollowing"]
+    profileName = output["profileName"]
+    searchable = output["searchable"]
+
+    # Check for featured viz.
+    featured_exists =  "featuredVizRepoUrl" in output
+    if featured_exists:
+        featuredVizRepoUrl = output["featuredVizRepoUrl"]
+    else:
+        featuredVizRepoUrl = ""
 
-            if processed == True:
-                # Just get the URL that's there and try to open it
-                urlStats = urlList[i]
+    # Check for avatar URL.
+    avatar_exists =  "avatarUrl" in output
+    if avatar_exists:
+        avatarUrl = output["avatarUrl"]
+    else:
+        avatarUrl = ""
+
+    # Check for websites.
+    websites_exists =  "websites" in output
+    if websites_exists:
+        websites = output["websites"]
+    else:
+        websites = ""
+
+    # Check for address.
+    address_exists =  "address" in output
+    if address_exists:
+        address = output["address"]
+        addressJson = json.loads(address)
+
+        # Convert address string to json and get components
+        country_exists =  "country" in addressJson
+        state_exists =  "state" in addressJson
+        city_exists =  "city" in addressJson
+        
+        if country_exists:
+            userCountry = addressJson["country"]
+        else:
+            userCountry = ""
+        
+        if state_exists:
+            userRegion = addressJson["state"]
+        else:
+            userRegion = ""
+        
+        if city_exists:
+            userCity = addressJson["city"]
+        else:
+            userCity = ""
+
+    else:
+        address = ""
+        userCountry = ""
+        userRegion = ""
+        userCity = ""
+
+    # Loop through websites and grab the ones we want
+    facebookURL = ""
+    twitterURL = ""
+    linkedinURL = ""
+    websiteURL = ""
+
+    for w in websites:
+        wTitle = w["title"]
+        wURL = w["url"]
+
+        if wTitle == "facebook.com":
+            facebookURL = wURL
+        elif wTitle == "twitter.com":
+            twitterURL = wURL
+        elif wTitle == "linkedin.com":
+            linkedinURL = wURL
+        else:
+            websiteURL = wURL
+
+    userColumns = [
+        userName,
+        profileName,
+        userOrg,
+        bio,
+        avatarUrl,
+        searchable,
+        featuredVizRepoUrl,
+        '',
+        followerCount,
+        totalNumberOfFollowing,
+        userCountry,
+        userRegion,
+        userCity,
+        websiteURL,
+        linkedinURL,
+        twitterURL,
+        facebookURL,
+        urlProfileOriginal,
+    ]
+
+    return userColumns
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Call the profile API, using the profile cache to skip the work for unchanged profiles. The call is made on every refresh, so
+# follower counts and profile changes are never stale. When the cached response came with an ETag or Last-Modified header, the
+# call is made conditional and a 304 means nothing changed. Otherwise the new response is compared with the hash of the cached
+# one, which only saves parsing it. Returns the response and the cached user columns, or None if the response needs to be parsed.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_profile (urlProfile, profileID, profileCache):
+    with profileCacheLock:
+        entry = profileCache.get(profileID)
+
+    now = datetime.datetime.now()
+    headers = {}
+
+    if entry is not None:
+        if entry['etag'] != '':
+            headers['If-None-Match'] = entry['etag']
+        if entry['lastModified'] != '':
+            headers['If-Modified-Since'] = entry['lastModified']
+
+    response = api_get(urlProfile, headers=headers)
+
+    if entry is None:
+        return response, None
+
+    unchanged = response.status_code == 304
+    if response.status_code == 200 and hashlib.sha256(response.content).hexdigest() == entry['hash']:
+        unchanged = True
+
+    if not unchanged:
+        return response, None
+
+    with profileCacheLock:
+        entry['checked'] = now.isoformat()
+
+    count_metric("ProfileCacheHits")
+    return response, list(entry['columns'])
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Store a profile API response's validators, content hash and parsed user columns in the profile cache.
+#------------------------------------------------------------------------------------------------------------------------------
+def put_cached_profile (profileCache, profileID, response, userColumns):
+    entry = {}
+    entry['etag'] = response.headers.get('ETag', '')
+    entry['lastModified'] = response.headers.get('Last-Modified', '')
+    entry['hash'] = hashlib.sha256(response.content).hexdigest()
+    entry['checked'] = datetime.datetime.now().isoformat()
+    entry['columns'] = userColumns
+
+    with profileCacheLock:
+        profileCache[profileID] = entry
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop profiles that haven't been checked for detailCacheMaxAge days, such as those that have left the service.
+#------------------------------------------------------------------------------------------------------------------------------
+def evict_profile_cache (profileCache):
+    oldest = (datetime.datetime.now() - datetime.timedelta(days=detailCacheMaxAge)).isoformat()
+
+    with profileCacheLock:
+        for profileID in [p for p, entry in profileCache.items() if entry['checked'] < oldest]:
+            del profileCache[profileID]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build a stats sheet's first worksheet from its sheet index entry. gspread reads the spreadsheet's metadata to build these, so
+# build them directly (as gspread would from that metadata) to save the two read requests.
+#------------------------------------------------------------------------------------------------------------------------------
+def build_worksheet (gc, entry):
+    properties = {"sheetId": entry["sheetId"], "title": entry["title"], "index": 0, "gridProperties": dict(entry["gridProperties"])}
+
+    # Spreadsheet's constructor reads the metadata, so only set what the worksheet calls need.
+    docStats = gspread.Spreadsheet.__new__(gspread.Spreadsheet)
+    docStats._properties = {"id": entry["key"]}
+
+    # gspread 6 sends requests through the client's HTTP client, and a worksheet also needs the spreadsheet key and that client.
+    httpClient = getattr(gc, "http_client", None)
+
+    if httpClient is None:
+        docStats.client = gc
+        return gspread.Worksheet(docStats, properties)
+
+    docStats.client = httpClient
+    return gspread.Worksheet(docStats, properties, entry["key"], httpClient)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the spreadsheet key from a stats URL, or None if it isn't a Google Sheets URL.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_sheet_key (urlStats):
+    try:
+        return gspread.utils.extract_id_from_url(urlStats)
+    except gspread.exceptions.NoValidUrlKeyFound:
+        return None
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Save a stats sheet's key, worksheet ID, title and grid size to the sheet index, under the spreadsheet key. (The key, rather
+# than the profile ID, since sign-up rows for the same profile each have their own sheet.)
+# gspread only reads a worksheet's properties when it's opened, so any properties a write has changed since are passed in.
+#------------------------------------------------------------------------------------------------------------------------------
+def index_stats_sheet (sheetIndex, sheetStats, written=None):
+    entry = {}
+    entry["key"] = sheetStats.spreadsheet.id
+    entry["sheetId"] = sheetStats.id
+    entry["title"] = sheetStats.title
+    entry["gridProperties"] = {"rowCount": sheetStats.row_count, "columnCount": sheetStats.col_count, "frozenRowCount": sheetStats.frozen_row_count}
+
+    if written is not None:
+        entry["title"] = written.get("title", entry["title"])
+        entry["gridProperties"].update(written["gridProperties"])
+
+    entry["indexed"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    with sheetIndexLock:
+        sheetIndex[entry["key"]] = entry
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Open the first worksheet of a stats sheet. If the sheet index has an entry for the URL's key, the worksheet is built from it.
+# Otherwise (or to rebuild an entry that turned out to be out of date) the sheet is opened by URL and indexed. Returns the
+# worksheet and whether it came from the index.
+#------------------------------------------------------------------------------------------------------------------------------
+def open_stats_sheet (gc, sheetIndex, urlStats, rebuild=False):
+    with sheetIndexLock:
+        entry = sheetIndex.get(get_sheet_key(urlStats))
+
+    if rebuild == False and entry is not None:
+        count_metric("SheetIndexHits")
+        return build_worksheet(gc, entry), True
+
+    with timed("OpenSpreadsheet"):
+        docStats = sheets_read(gc.open_by_url, urlStats)
+        sheetStats = sheets_read(docStats.get_worksheet, 0)
+
+    index_stats_sheet(sheetIndex, sheetStats)
+    return sheetStats, False
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Drop index entries for stats sheets that are no longer on the sign-up sheet and haven't been indexed for detailCacheMaxAge
+# days. (Sheets created during this run aren't on the list read at the start of it.)
+#------------------------------------------------------------------------------------------------------------------------------
+def evict_sheet_index (sheetIndex, urlList):
+    oldest = (datetime.datetime.now() - datetime.timedelta(days=detailCacheMaxAge)).strftime("%Y-%m-%d %H:%M:%S")
+    keys = set([get_sheet_key(url) for url in urlList])
+
+    with sheetIndexLock:
+        for key in [k for k, entry in sheetIndex.items() if k not in keys and entry["indexed"] < oldest]:
+            del sheetIndex[key]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Refresh the stats for a single profile. This runs on a worker thread, so it does not write to the sign-up sheet. Instead, it
+# returns the changes (new stats URL, refresh date) for the main thread to write.
+# If the deadline passes part way through the workbooks, the rows gathered so far are returned in result["partial"] so that the
+# next invocation can resume from the last completed page (passed back in as resume).
+# Any error not handled along the way is reported and returned as a failure (along with anything done before it, such as a
+# newly created sheet), so one bad profile can't stop the run.
+#------------------------------------------------------------------------------------------------------------------------------
+def refresh_profile (profile, credentials, deadline, detailCache, profileCache, sheetIndex, resume=None, shared=None):
+    result = {"row": profile["row"], "email": profile["email"], "firstName": profile["firstName"], "url": profile["url"], "profileID": normalize_profile_id(profile["profileID"]), "created": False, "new": False, "refreshDate": "", "partial": None, "summary": None, "history": None, "failure": None, "sharedFailure": False, "fetching": False}
+
+    try:
+        return refresh_stats(profile, result, credentials, deadline, detailCache, profileCache, sheetIndex, resume, shared)
+
+    except Exception as e:
+        msg = "Unable to refresh the profile, " + profile["profileID"] + ". Error: " + str(sys.exc_info()[0]) + " - " + str(e)
+        log (msg)
+
+        subject = "Tableau Public Stats Service - Error Processing Profile"
+        report_error(subject, "Refresh", msg, e)
+
+        result["failure"] = "Refresh"
+        result["partial"] = None
+
+        # If it broke while fetching the profile, the profile's other rows would only break the same way.
+        if shared is not None and result["fetching"] == True:
+            shared["failure"] = "Refresh"
+
+        return result
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Do the work of refresh_profile, filling in its result as it goes.
+#------------------------------------------------------------------------------------------------------------------------------
+def refresh_stats (profile, result, credentials, deadline, detailCache, profileCache, sheetIndex, resume, shared):
+    gc = get_worker_client(credentials)
+
+    firstName = profile["firstName"]
+    lastName = profile["lastName"]
+
+    # Get profile URL and and change it to use the API url.
+    profileID = profile["profileID"]
+    urlProfile = "https://public.tableau.com/profile/" + profileID + "#!/"
+    urlProfileOriginal = urlProfile
+    urlProfile = urlProfile.strip()
+    urlProfile = urlProfile[0:len(urlProfile)-3]
+    urlProfile = urlProfile + "/"
+    urlProfile = urlProfile.replace('https://public.tableau.com/profile', 'https://public.tableau.com/profile/api')
+
+    # Remove trailing slash if present
+    if urlProfile.endswith("/"):
+        urlProfile = urlProfile[:-1]
+
+    log ("Processing profile: " + lastName + ", " + firstName)
+
+    # If another sign-up row for the same profile couldn't fetch it this run, don't call the API again. The failure was already
+    # reported (and goes in the failure ledger once, for that row).
+    if shared is not None and "failure" in shared:
+        log ("Skipping profile " + profileID + ", which failed to fetch for another sign-up row.")
+        count_metric("ProfilesSharedFailures")
+
+        result["failure"] = shared["failure"]
+        result["sharedFailure"] = True
+        return result
+
+    if profile["url"] == "":
+        # Blank means this hasn't been processed. 
+        processed = False
+    else:
+        # This has already been processed.
+        processed = True
+
+    if processed == True:
+        # Just get the URL that's there and try to open it, using the sheet index if we can.
+        urlStats = profile["url"]
+
+        try:
+            sheetStats, indexed = open_stats_sheet(gc, sheetIndex, urlStats)
+
+        except:
+            msg = "Could not open the spreadsheet: " + urlStats + "."
+            log(msg)
+
+            subject = "Tableau Public Stats Service - Error Opening Spreadsheet"
+            report_error(subject, "Google Sheets", msg, sys.exc_info()[1])
+
+            # Report the error and let the admin look into the problem.
+            result["failure"] = "Google Sheets"
+            return result
+
+    else:
+        # Create a new spreadsheet, and assign permissions.
+        with timed("CreateSpreadsheet"):
+            docStats = sheets_write(gc.create, 'Stats: ' + lastName + ', ' + firstName)
+            sheets_write(docStats.share, ownerAddress, perm_type='user', role='writer')
+            sheets_write(docStats.share, profile["email"], perm_type='user', role='reader')
+        urlStats = 'https://docs.google.com/spreadsheets/d/' + docStats.id
+        log("Created new sheet: " + urlStats)
+
+        result["url"] = urlStats
+        result["created"] = True
+        result["new"] = True
+        sheetStats = sheets_read(docStats.get_worksheet, 0)
+        indexed = False
+
+    # Initialize Variables
+    pages = None
+    index = 0
+    vizCount = 0
+    rows = []
+    foundValid = 1
+    reused = False
+    startDate = datetime.date(year=1970, month=1, day=1)
+    timestamp = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+    # If another sign-up row for the same profile was refreshed just before this one, write the rows it fetched instead of
+    # calling the API again.
+    if shared is not None and "rows" in shared:
+        log ("Reusing the workbooks fetched for profile " + profileID + ".")
+        count_metric("ProfilesShared")
+
+        rows = [list(row) for row in shared["rows"]]
+        vizCount = len(rows)
+        lastUserPublishDateFormatted = shared["lastUserPublishDate"]
+        reused = True
+        foundValid = 0
+
+    # Start by calling the API to get user info. If the profile hasn't changed, the user columns from last time are reused.
+    if foundValid == 1:
+        result["fetching"] = True
+
+        with timed("ProfileApi"):
+            response, userColumns = get_profile(urlProfile, profileID, profileCache)
+
+        try:
+            if userColumns is None:
+                userColumns = get_user_columns(response.json(), urlProfileOriginal)
+                put_cached_profile(profileCache, profileID, response, userColumns)
+
+        except Exception as e:
+            # Some error occured. Report error and exit loop.
+            msg = "Unable to process the profile, " + profileID + " via API. Error: " + str(sys.exc_info()[0]) + " - " + str(e) 
+            log (msg)
+
+            subject = "Tableau Public Stats Service - Error Processing Profile"
+            report_error(subject, "Profile API", msg, e)
+            result["failure"] = "Profile API"
+
+            foundValid = 0
+
+    # Only resume from rows gathered for this profile and stats sheet. If the sign-up row has changed hands since, start over.
+    if resume is not None and is_same_row(resume, profileID, result["url"]) == False:
+        log ("Discarding the saved place for profile " + profileID + ", which was saved for another sign-up row.")
+        resume = None
+
+    # If the last invocation ran out of time part way through this profile, start from the rows it already gathered.
+    if resume is not None and foundValid == 1:
+        log ("Resuming profile " + profileID + " at workbook " + str(resume["index"]) + ".")
+        index = resume["index"]
+        result["new"] = resume["new"]
+
+        rows = resume["rows"]
+        vizCount = len(rows)
+
+        if vizCount > 0:
+            lastUserPublishDateFormatted = datetime.date.fromisoformat(resume["lastUserPublishDate"])
+
+    # Call the Tableau Public workbook API page by page and write to the Google Sheet. The next page is fetched while this one
+    # is being processed.
+    # Note: The API no longer allows public users to get a list of hidden workbooks.
+    if foundValid == 1:
+        pages = get_workbook_pages(profileID, index)
+
+    while (foundValid == 1):
+        # Out of time, so save our place for the next invocation rather than writing a partial sheet.
+        if datetime.datetime.now() >= deadline:
+            log ("Stopping profile " + profileID + " at workbook " + str(index) + " due to max runtime.")
+
+            partial = {}
+            partial["profileID"] = result["profileID"]
+            partial["url"] = result["url"]
+            partial["index"] = index
+            partial["new"] = result["new"]
+            partial["rows"] = rows
+
+            if vizCount > 0:
+                partial["lastUserPublishDate"] = lastUserPublishDateFormatted.isoformat()
+
+            result["partial"] = partial
+            pages.close()
+            return result
+
+        try:
+            page = next(pages, None)
+
+            if page is None:
+                # We're out of valid vizzes, so move on.
+                break
+
+            index, output = page
+
+            # Now get the details for each workbook on the page, from the cache or the Workbook Detail API.
+            workbookIDs = [o['workbookRepoUrl'] for o in output['contents']]
+            workbookDetails = get_workbook_details(output['contents'], detailCache)
+
+            for workbookID, wbStats in zip(workbookIDs, workbookDetails):
+                log ("Processing profile: " + lastName + ", " + firstName + ", Workbook ID " + workbookID)
+
+                # Get all the information about the workbook.
+                title = wbStats['title']
+                desc = wbStats['description']
+                defaultViewRepoUrl = wbStats['defaultViewRepoUrl']
+                defaultViewName = wbStats['defaultViewName']
+                showInProfile = wbStats['showInProfile']
+                viewCount = wbStats['viewCount']
+                numberOfFavorites = wbStats['numberOfFavorites']
+                permalink = wbStats['permalink']
+                firstPublishDate = wbStats['firstPublishDate']
+                lastPublishDate = wbStats['lastPublishDate']
+                revision = wbStats['revision']
+                size = wbStats['size']
+
+                # Calculations and cleanup of values.
+                firstPublishDateFormatted = startDate + datetime.timedelta(milliseconds=firstPublishDate)
+                lastPublishDateFormatted = startDate + datetime.timedelta(milliseconds=lastPublishDate)
+                
+                if vizCount == 0:
+                    # This is the first workbook so use initialize the date with this workbooks' date.
+                    lastUserPublishDateFormatted = lastPublishDateFormatted
+                else:
+                    if lastPublishDateFormatted > lastUserPublishDateFormatted:
+                        # Update the date to this more recent date.
+                        lastUserPublishDateFormatted = lastPublishDateFormatted
+
+                # Create the various URLs.
+                urlViz ="https://public.tableau.com/views/" + defaultViewRepoUrl.replace("/sheets","") 
+                urlVizNoVizHome = urlViz + "?:embed=y&:display_count=yes&:showVizHome=no" 
+                urlThumbnail = urlViz.replace("/views/", "/static/images/" + defaultViewRepoUrl[0:2] + "/") + "/4_3.png"
+                urlViz = urlProfileOriginal + "vizhome/" + defaultViewRepoUrl.replace("/sheets","")
+
+                # Store all values in a row, one value per column of the stats sheet.
+                row = [''] * len(statsHeader)
+                row[0]  = workbookID
+                row[1]  = title
+                row[2]  = desc
+                row[3]  = urlViz
+                row[4]  = urlVizNoVizHome
+                row[5]  = urlThumbnail
+                row[6]  = defaultViewName
+                row[7]  = showInProfile
+                row[8]  = permalink
+                row[9]  = viewCount
+                row[10] = numberOfFavorites
+                row[11] = str(firstPublishDateFormatted)
+                row[12] = str(lastPublishDateFormatted)
+                row[13] = revision
+                row[14] = size
+                # User columns, the same on every row.
+                row[15:33] = userColumns
+                row[22] = str(lastUserPublishDateFormatted)
+                row[33] = timestamp
+
+                rows.append(row)
+                vizCount += 1
+
+            # The next page starts where the API says it does.
+            index = get_next_start(index, output)
+
+        except Exception as e:
+            # Some error occured. Report error and exit loop.
+            msg = "Unable to process the profile, " + profileID + " via API. Error: " + str(sys.exc_info()[0]) + " - " + str(e) 
+            log (msg)
+
+            subject = "Tableau Public Stats Service - Error Processing Profile"
+            report_error(subject, "Workbooks API", msg, e)
+            result["failure"] = "Workbooks API"
+
+            foundValid = 0
+
+    if pages is not None:
+        pages.close()
+
+    result["fetching"] = False
+
+    # Keep what we fetched (or the failure) for the rest of the profile's sign-up rows, so the profile is fetched once per run.
+    if shared is not None and reused == False:
+        if result["failure"] is None:
+            shared["rows"] = rows
+            shared["lastUserPublishDate"] = lastUserPublishDateFormatted if vizCount > 0 else None
+        else:
+            shared["failure"] = result["failure"]
+
+    # Write the header and rows to each of the output sinks.
+    if vizCount > 0:
+        # Update user last published date
+        for row in rows:
+            row[22] = str(lastUserPublishDateFormatted)
+
+        if "sheets" in outputSinks:
+            try:
+                written = update_stats_sheet(sheetStats, rows, processed)
+
+            except gspread.exceptions.APIError as e:
+                # A worksheet built from the sheet index is out of date if the sheet was deleted or its first tab replaced. Open it
+                # by URL to rebuild the entry, then try again.
+                if indexed == False or e.response.status_code not in [400, 404]:
+                    raise
+
+                log ("The sheet index entry for " + urlStats + " is out of date. Opening it again.")
+                count_metric("SheetIndexRebuilds")
 
                 try:
-                    docStats = gc.open_by_url(urlStats)
-                    sheetStats = docStats.get_worksheet(0)
+                    sheetStats, indexed = open_stats_sheet(gc, sheetIndex, urlStats, rebuild=True)
 
                 except:
                     msg = "Could not open the spreadsheet: " + urlStats + "."
                     log(msg)
 
                     subject = "Tableau Public Stats Service - Error Opening Spreadsheet"
-                    phone_home(subject, msg)
-
-                    # Report the error and let the admin look into the problem.
-                    continueLoop = False
-            
-            if continueLoop == True:
-                if processed == False:
-                    # Create a new spreadsheet, and assign permissions.
-                    docStats = gc.create('Stats: ' + lastnameList[i] + ', ' + firstnameList[i])
-                    docStats.share(ownerAddress, perm_type='user', role='writer')
-                    docStats.share(emailList[i], perm_type='user', role='reader')
-                    urlStats = 'https://docs.google.com/spreadsheets/d/' + docStats.id
-                    log("Created new sheet: " + urlStats)
-
-                    sheetProfiles.update_cell(i+1, 6, urlStats)
-                    sheetStats = docStats.get_worksheet(0)
-
-                # Initialize Variables
-                pageCount = 50
-                index = 0
-                vizCount = 0
-                matrix = {}
-                foundValid = 1
-                startDate = datetime.date(year=1970, month=1, day=1)
-                timestamp = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
-
-                # Start by calling the API to get user info.
-                response = requests.get(urlProfile)
+                    report_error(subject, "Google Sheets", msg, sys.exc_info()[1])
 
-                try:
-                    output = response.json()
-                    userName = output["name"]
+                    with sheetIndexLock:
+                        sheetIndex.pop(get_sheet_key(urlStats), None)
 
-                    # Check for organization.
-                    org_exists =  "organization" in output
-                    if org_exists:
-                        userOrg = output["organization"]
-                    else:
-                        userOrg = ""
+                    result["failure"] = "Google Sheets"
+                    return result
 
-                    # Check for bio.
-                    bio_exists =  "bio" in output
-                    if bio_exists:
-                        bio = output["bio"]
-                    else:
-                        bio = ""
-                    
-                    # Get general information.
-                    followerCount = output["totalNumberOfFollowers"]
-                    totalNumberOfFollowing = output["totalNumberOfFollowing"]
-                    profileName = output["profileName"]
-                    searchable = output["searchable"]
-
-                    # Check for featured viz.
-                    featured_exists =  "featuredVizRepoUrl" in output
-                    if featured_exists:
-                        featuredVizRepoUrl = output["featuredVizRepoUrl"]
-                    else:
-                        featuredVizRepoUrl = ""
+                written = update_stats_sheet(sheetStats, rows, processed)
 
-                    # Check for avatar URL.
-                    avatar_exists =  "avatarUrl" in output
-                    if avatar_exists:
-                        avatarUrl = output["avatarUrl"]
-                    else:
-                        avatarUrl = ""
+            # The write may have renamed, grown or frozen the worksheet, so save its properties again.
+            index_stats_sheet(sheetIndex, sheetStats, written)
 
-                    # Check for websites.
-                    websites_exists =  "websites" in output
-                    if websites_exists:
-                        websites = output["websites"]
-                    else:
-                        websites = ""
-
-                    # Check for address.
-                    address_exists =  "address" in output
-                    if address_exists:
-                        address = output["address"]
-                        addressJson = json.loads(address)
-
-                        # Convert address string to json and get components
-                        country_exists =  "country" in addressJson
-                        state_exists =  "state" in addressJson
-                        city_exists =  "city" in addressJson
-                        
-                        if country_exists:
-                            userCountry = addressJson["country"]
-                        else:
-                            userCountry = ""
-                        
-                        if state_exists:
-                            userRegion = addressJson["state"]
-                        else:
-                            userRegion = ""
-                        
-                        if city_exists:
-                            userCity = addressJson["city"]
-                        else:
-                            userCity = ""
+        if "export" in outputSinks and reused == False:
+            try:
+                write_export("stats/" + profileID, statsHeader, rows)
+
+            except Exception as e:
+                # Don't let a failed export stop the refresh. Just report it.
+                msg = "Unable to export the stats for " + profileID + ". Error: " + str(sys.exc_info()[0]) + " - " + str(e)
+                log (msg)
+
+                subject = "Tableau Public Stats Service - Error Exporting Stats"
+                report_error(subject, "Export", msg, e)
+
+        log ("Wrote " + str(vizCount) + " records.")
+
+        # Return the last refreshed date for the main thread to populate.
+        result["refreshDate"] = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Return the profile's totals for the summary store, so Summarize doesn't have to read the sheet back.
+        result["summary"] = get_summary_record(rows)
+
+        # Return each workbook's views and favorites for the main thread to save to the history.
+        result["history"] = [(row[0], int(row[9] or 0), int(row[10] or 0)) for row in rows]
+
+    else:
+        log ("No records written.")
+
+    return result
+
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Normalize a profile ID from the sign-up sheet, so the same profile entered on several rows (or with different case or spacing)
+# is fetched once.
+#------------------------------------------------------------------------------------------------------------------------------
+def normalize_profile_id (profileID):
+    return profileID.strip().lower()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Check that a run cursor entry (a finished or in-flight profile) still belongs to the same sign-up row. Rows move up when one
+# above them is deleted, so the entry's profile ID and stats URL have to match what's on the row now.
+#------------------------------------------------------------------------------------------------------------------------------
+def is_same_row (entry, profileID, url):
+    return isinstance(entry, dict) and entry.get("profileID") == normalize_profile_id(profileID) and entry.get("url") == url
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Refresh every sign-up row for one profile, in priority order. The first row fetches the profile from Tableau Public and the
+# rest write the same rows to their own stats sheets. If the fetch fails, the rest fail with it rather than fetching again (a
+# row that fails before fetching, such as on its stats sheet, leaves the fetch to the next row). The fetched rows are only held
+# until the group is done. If the deadline stops the first row part way through, the rest are left for the next
+# invocation.
+#------------------------------------------------------------------------------------------------------------------------------
+def refresh_group (profiles, credentials, deadline, detailCache, profileCache, sheetIndex, resume=None):
+    shared = {}
+    results = []
+
+    for profile in profiles:
+        result = refresh_profile(profile, credentials, deadline, detailCache, profileCache, sheetIndex, resume, shared)
+        results.append(result)
+        resume = None
+
+        if result["partial"] is not None:
+            break
 
+    return results
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Queue a change to a single cell of the sign-up sheet.
+#------------------------------------------------------------------------------------------------------------------------------
+def queue_signup_update (signupQueue, row, column, value):
+    signupQueue["updates"].append({"range": gspread.utils.rowcol_to_a1(row, column), "values": [[value]]})
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write the queued sign-up sheet changes in a single batch request. Unless forced, this waits until enough changes are queued
+# or enough time has passed since the last write.
+#------------------------------------------------------------------------------------------------------------------------------
+def flush_signup_updates (sheetProfiles, signupQueue, force=False):
+    updates = signupQueue["updates"]
+    secondsWaiting = (datetime.datetime.now() - signupQueue["flushed"]).total_seconds()
+
+    if len(updates) == 0:
+        return
+
+    if force == True or len(updates) >= signupFlushSize or secondsWaiting >= signupFlushSeconds:
+        # Values are entered as if typed, the same as update_cell.
+        with timed("WriteSignup"):
+            sheets_write(sheetProfiles.batch_update, updates, value_input_option="USER_ENTERED")
+
+        signupQueue["updates"] = []
+        signupQueue["flushed"] = datetime.datetime.now()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Queue a finished profile's changes to the sign-up sheet and the welcome email for new users, then note the profile as
+# finished (or still in flight) in the run cursor, save its workbooks to the history, store its totals in the summary store and
+# update the failure ledger. Returns the number of new subscribers (0 or 1).
+#------------------------------------------------------------------------------------------------------------------------------
+def record_result (signupQueue, cursor, summaryStore, historyDB, failureLedger, result):
+    i = result["row"]
+    newCount = 0
+
+    if result["partial"] is not None:
+        cursor["inFlight"][str(i)] = result["partial"]
+        count_metric("ProfilesStopped")
+    else:
+        cursor["inFlight"].pop(str(i), None)
+        cursor["finished"].append({"row": i, "profileID": result["profileID"], "url": result["url"]})
+
+        if result["refreshDate"] != "":
+            count_metric("ProfilesRefreshed")
+        else:
+            count_metric("ProfilesNotRefreshed")
+
+    if result["created"] == True:
+        # Populate the URL of the newly created sheet.
+        queue_signup_update(signupQueue, i+1, 6, result["url"])
+
+    if result["refreshDate"] != "":
+        # If a new user, send the welcome email.
+        if result["new"] == True:
+            queue_new_user_email(result["email"], result["firstName"], result["url"])
+            newCount += 1
+
+        # Populate the last refreshed date.
+        queue_signup_update(signupQueue, i+1, 7, result["refreshDate"])
+
+    if result["history"] is not None:
+        # Save the workbook history, then add what the profile gained recently to its totals.
+        record_history(historyDB, result["profileID"], result["history"])
+        result["summary"]["viewsGained"], result["summary"]["favoritesGained"] = get_history_delta(historyDB, result["profileID"], historyDeltaDays)
+
+    if result["summary"] is not None:
+        summaryStore[result["url"]] = result["summary"]
+
+    # A refresh clears the failures of the profile and of the row's stats sheet. A row that failed without refreshing backs off
+    # (or is quarantined). A failure copied from another row of the same profile was already counted.
+    if result["refreshDate"] != "":
+        failureLedger.pop(result["profileID"], None)
+        failureLedger.pop(result["url"], None)
+    elif result["failure"] is not None and result["sharedFailure"] == False:
+        record_failure(failureLedger, get_failure_key(result), result["failure"])
+
+    return newCount
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Main lambda handler
+#------------------------------------------------------------------------------------------------------------------------------
+def lambda_handler(event, context):
+    # Get the start time so we can end the program before exceeding lambda max runtimes (900 seconds)
+    startTime = datetime.datetime.now()
+
+    reset_metrics()
+
+    # Get the Google Sheets client, reading the credentials from S3 on a cold start.
+    s3 = get_aws_client('s3')
+    gc = get_sheets_client()
+
+    # The workers share the client's credentials, and so its token.
+    credentials = getattr(gc, "http_client", gc).auth
+
+    # Read the sign-up sheet
+    with timed("ReadSignup"):
+        docProfiles = sheets_read(gc.open_by_url, 'https://docs.google.com/spreadsheets/d/' + worksheetID)
+        sheetProfiles = sheets_read(docProfiles.get_worksheet, 0)
+        signupRows = sheets_read(sheetProfiles.get_values, "A:G")
+
+    # Read all of the sign-up rows in one request. Pad each row out to column G, since blank cells at the end are left off.
+    signupValues = [values + [''] * (7 - len(values)) for values in signupRows]
+
+    emailList = [values[1] for values in signupValues]
+    firstnameList = [values[2] for values in signupValues]
+    lastnameList = [values[3] for values in signupValues]
+    profileList = [values[4] for values in signupValues]
+    urlList = [values[5] for values in signupValues]
+    dateList = [values[6] for values in signupValues]
+    profileCount = len(signupValues)
+
+    # Initialize some variables.
+    newCount = 0
+    timedOut = False
+    running = set()
+    signupQueue = {"updates": [], "flushed": datetime.datetime.now()}
+    deadline = startTime + datetime.timedelta(seconds=maxRuntime)
+
+    # Load the run cursor so we can pick up where the last invocation stopped. Profiles already finished in this pass are skipped.
+    cursor = load_state(s3, cursorFile, {"finished": [], "inFlight": {}})
+
+    # Entries are kept by row, so drop any whose row no longer has the same profile and stats URL (say, a row above it was
+    # deleted). Those rows are refreshed from scratch.
+    cursor["finished"] = [entry for entry in cursor["finished"] if isinstance(entry, dict) and entry["row"] < profileCount and is_same_row(entry, profileList[entry["row"]], urlList[entry["row"]])]
+    cursor["inFlight"] = {row: partial for row, partial in cursor["inFlight"].items() if int(row) < profileCount and is_same_row(partial, profileList[int(row)], urlList[int(row)])}
+    finished = set(entry["row"] for entry in cursor["finished"])
+
+    # Load the workbook detail and profile caches, the stats sheet index and the summary store.
+    detailCache = load_state(s3, detailCacheFile, {})
+    profileCache = load_state(s3, profileCacheFile, {})
+    sheetIndex = load_state(s3, sheetIndexFile, {})
+    summaryStore = load_state(s3, summaryFile, {})
+
+    # Load the failure ledger, so profiles that keep failing wait their turn.
+    failureLedger = load_state(s3, failureFile, {})
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # Open the workbook history. Only the main thread uses it.
+    historyDB = open_history(s3)
+
+    # Everything from here on is saved in the finally block, even if the run stops on an error, so that the stats URLs of new
+    # sheets and the state for the next invocation aren't lost.
+    try:
+        # Work out how stale every profile is, then queue the ones that need a refresh, in priority order:
+        #   0. Profiles the last invocation stopped part way through.
+        #   1. Profiles that have waited maxWaitHours or more, so busy days can't starve the same rows over and over.
+        #   2. New sign-ups, which don't have a stats sheet yet.
+        #   3. Everything else due for a refresh, most stale first.
+        queue = []
+
+        for i in range(1, profileCount):
+            if i in finished:
+                continue
+
+            # Skip rows still backing off after a failure, or quarantined, whether the profile failed or the row's stats sheet did.
+            failures = [failureLedger.get(key) for key in [normalize_profile_id(profileList[i]), urlList[i]] if key != ""]
+            if any(failure is not None and failure["retryAfter"] > now for failure in failures) and str(i) not in cursor["inFlight"]:
+                count_metric("ProfilesBackingOff")
+                continue
+
+            refreshDateStr = ''
+
+            # Get the last refresh date.
+            if len(dateList) <= i:
+                # No value. Set way back.
+                refreshDateStr = "2000-01-01 00:00:00"
+            elif len(urlList) <= i or urlList[i] == "":
+                # Blank. Set way back.
+                refreshDateStr = "2000-01-01 00:00:00"
+            else:
+                # Use the value.
+                refreshDateStr = dateList[i]
+
+            # If still blank, set back.
+            if refreshDateStr == '':
+                refreshDateStr = "2000-01-01 00:00:00"
+
+            refreshDate = datetime.datetime.strptime(refreshDateStr, "%Y-%m-%d %H:%M:%S")
+            dateDiff = datetime.datetime.now() - refreshDate
+            hoursSinceRefresh = dateDiff.total_seconds()/3600
+
+            if str(i) in cursor["inFlight"]:
+                heapq.heappush(queue, (0, -hoursSinceRefresh, i))
+            elif len(urlList) <= i or urlList[i] == "":
+                heapq.heappush(queue, (2, -hoursSinceRefresh, i))
+            elif hoursSinceRefresh >= maxWaitHours:
+                heapq.heappush(queue, (1, -hoursSinceRefresh, i))
+            elif hoursSinceRefresh >= refreshHours:
+                heapq.heappush(queue, (3, -hoursSinceRefresh, i))
+
+        log (str(len(queue)) + " profiles are due for a refresh.")
+
+        # Group the queued rows by profile, so a profile on several sign-up rows is fetched once. Rows without a profile ID are
+        # left on their own.
+        groups = {}
+        for entry in queue:
+            groupKey = normalize_profile_id(profileList[entry[2]])
+            if groupKey == "":
+                groupKey = "row " + str(entry[2])
+
+            groups.setdefault(groupKey, []).append(entry)
+
+        grouped = set()
+
+        # Refresh the queued profiles, up to profileWorkers of them at a time. Each profile's rows go to the same worker, starting
+        # with the row that came off the queue first.
+        with ThreadPoolExecutor(max_workers=profileWorkers) as executor:
+            while len(queue) > 0:
+                priority, hoursSinceRefresh, i = heapq.heappop(queue)
+
+                # Already refreshed with an earlier row for the same profile.
+                if i in grouped:
+                    continue
+
+                # Wait for a free worker, recording the results of the profiles that finish.
+                if len(running) >= profileWorkers:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        for result in future.result():
+                            newCount += record_result(signupQueue, cursor, summaryStore, historyDB, failureLedger, result)
+
+                    flush_signup_updates(sheetProfiles, signupQueue)
+
+                # Check time so we can end the program before exceeding lambda max runtimes (900 seconds)
+                checkTime = datetime.datetime.now()
+                dateDiff = checkTime - startTime
+                secondsRunning = dateDiff.seconds
+
+                if secondsRunning >= maxRuntime:
+                    timedOut = True
+                    break
+
+                groupKey = normalize_profile_id(profileList[i])
+                if groupKey == "":
+                    groupKey = "row " + str(i)
+
+                profiles = []
+                for entry in sorted(groups[groupKey]):
+                    j = entry[2]
+                    grouped.add(j)
+
+                    profile = {}
+                    profile["row"] = j
+                    profile["email"] = emailList[j]
+                    profile["firstName"] = firstnameList[j]
+                    profile["lastName"] = lastnameList[j]
+                    profile["profileID"] = profileList[j]
+
+                    if len(urlList) <= j:
+                        profile["url"] = ""
                     else:
-                        address = ""
-                        userCountry = ""
-                        userRegion = ""
-                        userCity = ""
-
-                    # Loop through websites and grab the ones we want
-                    facebookURL = ""
-                    twitterURL = ""
-                    linkedinURL = ""
-                    websiteURL = ""
-
-                    for w in websites:
-                        wTitle = w["title"]
-                        wURL = w["url"]
-
-                        if wTitle == "facebook.com":
-                            facebookURL = wURL
-                        elif wTitle == "twitter.com":
-                            twitterURL = wURL
-                        elif wTitle == "linkedin.com":
-                            linkedinURL = wURL
-                        else:
-                            websiteURL = wURL
-
-                except Exception as e:
-                    # Some error occured. Report error and exit loop.
-                    msg = "Unable to process the profile, " + profileID + " via API. Error: " + str(sys.exc_info()[0]) + " - " + str(e) 
-                    log (msg)
-
-                    subject = "Tableau Public Stats Service - Error Processing Profile"
-                    phone_home (subject, msg)
-
-                    foundValid = 0
-
-                # Call the Tableau Public workbook API in chunks and write to the Google Sheet.
-                # Note: The API no longer allows public users to get a list of hidden workbooks.
-                while (foundValid == 1):
-                    parameters = {"count": pageCount, "start": index, "profileName": profileID, "visibility": "NON_HIDDEN"}
-                    response = requests.get(urlProfileWB, params=parameters)
-
-                    try:
-                        output = response.json()
-
-                        for o in output['contents']:    
-                            # Now call the Workbook Detail API for each workbook.
-                            workbookID = o['workbookRepoUrl']
-                            log ("Processing profile: " + lastnameList[i] + ", " + firstnameList[i] + ", Workbook ID " + workbookID)
-
-                            urlWorkbook = "https://public.tableau.com/profile/api/single_workbook/" + workbookID + "?"
-                            response = requests.get(urlWorkbook)
-                            wbStats = response.json()
-
-                            # Get all the information about the workbook.
-                            title = wbStats['title']
-                            desc = wbStats['description']
-                            defaultViewRepoUrl = wbStats['defaultViewRepoUrl']
-                            defaultViewName = wbStats['defaultViewName']
-                            showInProfile = wbStats['showInProfile']
-                            viewCount = wbStats['viewCount']
-                            numberOfFavorites = wbStats['numberOfFavorites']
-                            permalink = wbStats['permalink']
-                            firstPublishDate = wbStats['firstPublishDate']
-                            lastPublishDate = wbStats['lastPublishDate']
-                            revision = wbStats['revision']
-                            size = wbStats['size']
-
-                            # Calculations and cleanup of values.
-                            firstPublishDateFormatted = startDate + datetime.timedelta(milliseconds=firstPublishDate)
-                            lastPublishDateFormatted = startDate + datetime.timedelta(milliseconds=lastPublishDate)
-                            
-                            if vizCount == 0:
-                                # This is the first workbook so use initialize the date with this workbooks' date.
-                                lastUserPublishDateFormatted = lastPublishDateFormatted
-                            else:
-                                if lastPublishDateFormatted > lastUserPublishDateFormatted:
-                                    # Update the date to this more recent date.
-                                    lastUserPublishDateFormatted = lastPublishDateFormatted
-
-                            # Create the various URLs.
-                            urlViz ="https://public.tableau.com/views/" + defaultViewRepoUrl.replace("/sheets","") 
-                            urlVizNoVizHome = urlViz + "?:embed=y&:display_count=yes&:showVizHome=no" 
-                            urlThumbnail = urlViz.replace("/views/", "/static/images/" + defaultViewRepoUrl[0:2] + "/") + "/4_3.png"
-                            urlViz = urlProfileOriginal + "vizhome/" + defaultViewRepoUrl.replace("/sheets","")
-
-                            # Store all values in an array.
-                            matrix[vizCount, 0]  = workbookID
-                            matrix[vizCount, 1]  = title
-                            matrix[vizCount, 2]  = desc
-                            matrix[vizCount, 3]  = urlViz
-                            matrix[vizCount, 4]  = urlVizNoVizHome
-                            matrix[vizCount, 5]  = urlThumbnail
-                            matrix[vizCount, 6]  = defaultViewName
-                            matrix[vizCount, 7]  = showInProfile
-                            matrix[vizCount, 8]  = permalink
-                            matrix[vizCount, 9]  = viewCount
-                            matrix[vizCount, 10] = numberOfFavorites
-                            matrix[vizCount, 11] = str(firstPublishDateFormatted)
-                            matrix[vizCount, 12] = str(lastPublishDateFormatted)
-                            matrix[vizCount, 13] = revision
-                            matrix[vizCount, 14] = size
-                            matrix[vizCount, 15] = userName
-                            matrix[vizCount, 16] = profileName
-                            matrix[vizCount, 17] = userOrg
-                            matrix[vizCount, 18] = bio   
-                            matrix[vizCount, 19] = avatarUrl
-                            matrix[vizCount, 20] = searchable
-                            matrix[vizCount, 21] = featuredVizRepoUrl
-                            matrix[vizCount, 22] = str(lastUserPublishDateFormatted)
-                            matrix[vizCount, 23] = followerCount
-                            matrix[vizCount, 24] = totalNumberOfFollowing
-                            matrix[vizCount, 25] = userCountry
-                            matrix[vizCount, 26] = userRegion
-                            matrix[vizCount, 27] = userCity
-                            matrix[vizCount, 28] = websiteURL
-                            matrix[vizCount, 29] = linkedinURL
-                            matrix[vizCount, 30] = twitterURL
-                            matrix[vizCount, 31] = facebookURL
-                            matrix[vizCount, 32] = urlProfileOriginal
-                            matrix[vizCount, 33] = timestamp
-
-                            vizCount += 1
-                    
-                        if output['next'] == -1:
-                            # We're out of valid vizzes, so move on.
-                            foundValid = 0
-                        else:
-                            # Keep going.
-                            foundValid = 1
-
-                    except Exception as e:
-                        # Some error occured. Report error and exit loop.
-                        msg = "Unable to process the profile, " + profileID + " via API. Error: " + str(sys.exc_info()[0]) + " - " + str(e) 
-                        log (msg)
-
-                        subject = "Tableau Public Stats Service - Error Processing Profile"
-                        phone_home (subject, msg)
-
-                        foundValid = 0
-
-                    index += pageCount
-
-                # Loop through the matrix and write values for a batch update to Google Sheets.
-                if vizCount > 0:
-                    # Update user last published date
-                    for vizIndex in range(0, vizCount):
-                        matrix[vizIndex, 22] = str(lastUserPublishDateFormatted)
-
-                    # Set the cell range.
-                    rangeString = "A2:AH" + str(vizCount+1)
-                    cell_list = sheetStats.range(rangeString)
-
-                    # Loop through all the cells in the range, populating from the matrix.
-                    row = 0
-                    column = 0
-
-                    for cell in cell_list: 
-                        cell.value = matrix[row,column]
-                        column += 1
-                        if (column > 33):
-                            column=0
-                            row += 1
-
-                    # Clear the sheet then update in batch
-                    sheetStats.clear()
-                    sheetStats.update_cells(cell_list)
-
-                    # Write the header
-                    matrix = {}
-                    matrix[0, 0] =  "Viz - ID"
-                    matrix[0, 1] =  "Viz - Title"
-                    matrix[0, 2] =  "Viz - Description"
-                    matrix[0, 3] =  "Viz - URL"
-                    matrix[0, 4] =  "Viz - URL (No Home)"
-                    matrix[0, 5] =  "Viz - Thumbnail URL"
-                    matrix[0, 6] =  "Viz - Default View"
-                    matrix[0, 7] =  "Viz - Visible"
-                    matrix[0, 8] =  "Viz - Permalink"
-                    matrix[0, 9] =  "Viz - Views"
-                    matrix[0, 10] = "Viz - Favorites"
-                    matrix[0, 11] = "Viz - First Published"
-                    matrix[0, 12] = "Viz - Last Published"
-                    matrix[0, 13] = "Viz - Revision"
-                    matrix[0, 14] = "Viz - Size"
-                    matrix[0, 15] = "User - Name"
-                    matrix[0, 16] = "User - Profile ID"
-                    matrix[0, 17] = "User - Organization"
-                    matrix[0, 18] = "User - Bio"
-                    matrix[0, 19] = "User - Avatar URL"
-                    matrix[0, 20] = "User - Searchable"
-                    matrix[0, 21] = "User - Featured Viz"
-                    matrix[0, 22] = "User - Last Published"
-                    matrix[0, 23] = "User - Follower Count"
-                    matrix[0, 24] = "User - Following Count"
-                    matrix[0, 25] = "User - Country"
-                    matrix[0, 26] = "User - State or Region"
-                    matrix[0, 27] = "User - City"
-                    matrix[0, 28] = "User - Website"
-                    matrix[0, 29] = "User - LinkedIn"
-                    matrix[0, 30] = "User - Twitter"
-                    matrix[0, 31] = "User - Facebook"
-                    matrix[0, 32] = "User - Tableau Public"
-                    matrix[0, 33] = "Stats - Stats Last Refreshed"
-
-                    # Set the range for the header.
-                    rangeString = "A1:AH1"
-                    cell_list = sheetStats.range(rangeString)
-
-                    # Loop through all the cells in the range, populating from the matrix.
-                    row = 0
-                    column = 0
-
-                    for cell in cell_list: 
-                        cell.value = matrix[row,column]
-
-                        column += 1
-
-                    # Update in batch.
-                    sheetStats.update_cells(cell_list)
-
-                    # Finishing touches
-                    rangeString = "A1:AH" + str(vizCount+1)
-                    sheetStats.format(rangeString, {"verticalAlignment": "TOP"})
-
-                    rangeString = "A1:AH1"
-                    sheetStats.format(rangeString, {'textFormat': {'bold': True}})
-
-                    sheetStats.freeze(rows=1)
-                    sheetStats.update_title ("Stats")
-
-                    log ("Wrote " + str(vizCount) + " records.")
-
-                    # If a new user, send the welcome email.
-                    if processed == False:
-                        send_new_user_email(emailList[i], firstnameList[i], urlStats)
-                        newCount += 1
-
-                    # Populate the last refreshed date.
-                    refreshDate = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
-                    sheetProfiles.update_cell(i+1, 7, refreshDate)
+                        profile["url"] = urlList[j]
 
-                else:
-                    log ("No records written.")
+                    profiles.append(profile)
+
+                resume = cursor["inFlight"].get(str(i))
+                running.add(executor.submit(refresh_group, profiles, credentials, deadline, detailCache, profileCache, sheetIndex, resume))
+
+            # Wait for the remaining profiles to finish.
+            for future in wait(running).done:
+                for result in future.result():
+                    newCount += record_result(signupQueue, cursor, summaryStore, historyDB, failureLedger, result)
+
+    finally:
+        # Write whatever is left in the sign-up queue.
+        flush_signup_updates(sheetProfiles, signupQueue, force=True)
+
+        # Save the workbook detail and profile caches for the next invocation.
+        evict_detail_cache(detailCache)
+        save_state(s3, detailCacheFile, detailCache)
+
+        evict_profile_cache(profileCache)
+        save_state(s3, profileCacheFile, profileCache)
+
+        # Save the stats sheet index for both Stats and Summarize.
+        evict_sheet_index(sheetIndex, urlList)
+        save_state(s3, sheetIndexFile, sheetIndex)
+
+        # Save the failure ledger.
+        evict_failure_ledger(failureLedger, [normalize_profile_id(profileID) for profileID in profileList] + urlList)
+        save_state(s3, failureFile, failureLedger)
+
+        # Save the profile totals for Summarize.
+        evict_summary_store(summaryStore, urlList)
+        save_state(s3, summaryFile, summaryStore)
+
+        # Save the workbook history.
+        save_history(s3, historyDB)
+
+        # Save our place, so the next invocation picks up where this one stopped (even if it stopped on an error).
+        save_state(s3, cursorFile, cursor)
+
+        # Wait for the welcome emails to go out, then send whatever errors are left in the digest.
+        wait_for_emails()
+        send_error_digest()
+
+        emit_metrics("Stats")
+
+    # Profiles stopped part way through need another invocation, even if the queue itself was emptied.
+    if len(cursor["inFlight"]) > 0:
+        timedOut = True
+
+    if timedOut == True:
+        # Our place for the next invocation has already been saved.
+        end_function("Program exceeded max runtime and was forced to end.")
 
+    # Every profile that was due has been refreshed, so the next invocation starts a new pass.
+    save_state(s3, cursorFile, {"finished": [], "inFlight": {}})
 
     # Send email to Ken, indicating the number of new subscribers.
     if newCount > 0:
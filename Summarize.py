@@ -1,20 +1,68 @@
 #  This code will loop through loop through the stats Google sheets then summarize them--one row per profile--in another Google Sheet.
 #  Written by Ken Flerlage, January, 2023.
 
+import os
+import io
+import csv
+import gzip
 import sys
 import json
 import gspread
 import datetime
 import time
+import random
 import boto3
+import threading
 from oauth2client.service_account import ServiceAccountCredentials
 from botocore.exceptions import ClientError
+from contextlib import contextmanager
 
 senderAddress = "Sender Name <email address>"                           # From name/email address for emails.
 ownerAddress = "email address"                                          # From email address for emails.
 s3Bucket = "bucket name"                                                # Name of the S3 bucket containing the credentials file.
 credsFile = "creds file name"                                           # Name of the credentials file in the S3 bucket.
 worksheetID = "Worksheet ID"                                            # ID of the Sign-Up Google Sheet.
+summaryFile = "stats-summary.json"                                      # Name of the summary store file (written by Stats) in the S3 bucket.
+sheetIndexFile = "stats-sheet-index.json"                               # Name of the stats sheet index file (written by Stats) in the S3 bucket.
+exportLocation = "s3://bucket name/exports"                             # Where the export sink writes: s3://bucket/prefix or a local directory.
+
+# Google Sheets API quotas, per minute for our service account. Every Sheets call waits for a token from the matching bucket.
+# When a call still comes back with a quota error (429), the bucket slows down and the call is retried up to sheetsRetries times.
+sheetsReadsPerMinute = 60
+sheetsWritesPerMinute = 60
+sheetsRetries = 5
+
+# CloudWatch namespace for the metrics written at the end of each run, and the upper bounds (ms) of the latency histogram buckets.
+# Embedded Metric Format allows at most metricsPerDirective metrics in each CloudWatchMetrics directive.
+metricsNamespace = "TableauPublicStats"
+metricsBuckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+metricsPerDirective = 100
+
+# Refresh the Google access token before a run if it expires within this many seconds, so it lasts the whole run. The
+# credentials file is read from S3 again once the cached copy is credsMaxAgeHours old.
+tokenRefreshSeconds = 900
+credsMaxAgeHours = 12
+
+# Errors are collected and emailed as one digest at the end of the run, or as soon as errorDigestSize are waiting. The digest
+# groups them by type and endpoint, with up to errorDigestSamples example messages for each group.
+errorDigestSize = 100
+errorDigestSamples = 5
+
+# Days covered by the views and favorites gained columns of the Summary sheet (the same as historyDeltaDays in Stats.py).
+historyDeltaDays = 7
+
+# Where the summary goes. "sheets" writes the Summary sheet. Add "export" to also write it as one compressed file under
+# exportLocation, in exportFormat: "parquet" (if pyarrow is installed) or "csv" (gzip).
+outputSinks = ["sheets"]
+exportFormat = "parquet"
+
+# Clients and credentials, kept between invocations while the Lambda container stays warm.
+clientCache = {}
+clientCacheLock = threading.Lock()
+
+# Errors waiting for the next digest email.
+errorDigest = []
+errorDigestLock = threading.Lock()
 
 #------------------------------------------------------------------------------------------------------------------------------
 # Email new user
@@ -54,8 +102,8 @@ def send_new_user_email (email, firstName, url):
     # The character encoding for the email.
     charSet = "UTF-8"
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=region)
+    # Get the SES client for the region.
+    client = get_aws_client('ses', region)
 
     # Try to send the email.
     try:
@@ -108,7 +156,7 @@ def phone_home (subject, msg):
     <html>
     <head></head>
     <body>
-    <p style="font-family:Georgia;font-size:15px">""" + msg + """</p>
+    <p style="font-family:Georgia;font-size:15px">""" + msg.replace("\r\n", "<br>") + """</p>
     </body>
     </html>
     """            
@@ -116,8 +164,8 @@ def phone_home (subject, msg):
     # The character encoding for the email.
     charSet = "UTF-8"
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=region)
+    # Get the SES client for the region.
+    client = get_aws_client('ses', region)
 
     # Try to send the email.
     try:
@@ -157,6 +205,300 @@ def log (msg):
     logTimeStamp = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
     print(str(logTimeStamp) + ": " + msg)
 
+#------------------------------------------------------------------------------------------------------------------------------
+# Record an error for the digest email. Errors are grouped by type (the subject), the endpoint that failed and the exception.
+# The digest goes out straight away once errorDigestSize errors are waiting.
+#------------------------------------------------------------------------------------------------------------------------------
+def report_error (subject, endpoint, msg, error=None):
+    errorType = ""
+    if error is not None:
+        errorType = type(error).__name__
+
+    with errorDigestLock:
+        errorDigest.append({"subject": subject, "endpoint": endpoint, "type": errorType, "msg": msg})
+        full = len(errorDigest) >= errorDigestSize
+
+    count_metric("ErrorsReported")
+
+    if full:
+        send_error_digest()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Email the waiting errors as one digest, largest group first.
+#------------------------------------------------------------------------------------------------------------------------------
+def send_error_digest ():
+    with errorDigestLock:
+        errors = list(errorDigest)
+        errorDigest.clear()
+
+    if len(errors) == 0:
+        return
+
+    groups = {}
+    for error in errors:
+        groups.setdefault((error["subject"], error["endpoint"], error["type"]), []).append(error["msg"])
+
+    lines = [str(len(errors)) + " errors were reported."]
+
+    for (subject, endpoint, errorType), messages in sorted(groups.items(), key=lambda group: -len(group[1])):
+        heading = subject + " - " + endpoint
+        if errorType != "":
+            heading += " (" + errorType + ")"
+
+        lines.append("")
+        lines.append(heading + ": " + str(len(messages)) + " errors")
+
+        for msg in messages[0:errorDigestSamples]:
+            lines.append("    " + msg)
+
+        if len(messages) > errorDigestSamples:
+            lines.append("    ... and " + str(len(messages) - errorDigestSamples) + " more.")
+
+    subject = "Tableau Public Stats Sumarization" + " - " + str(len(errors)) + " Errors"
+    phone_home(subject, "\r\n".join(lines))
+    count_metric("ErrorDigestsSent")
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the boto3 client for an AWS service. Clients are created on first use and reused for the life of the container, so a
+# run that sends no email never sets up SES.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_aws_client (service, region=None):
+    with clientCacheLock:
+        if service not in clientCache:
+            if region is None:
+                clientCache[service] = boto3.client(service)
+            else:
+                clientCache[service] = boto3.client(service, region_name=region)
+
+        return clientCache[service]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get the Google Sheets client. The credentials file is read from S3 and authorized on a cold start (or once the cached copy
+# is credsMaxAgeHours old), then reused. The access token is only refreshed when it's close to expiring.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_sheets_client ():
+    s3 = get_aws_client('s3')
+
+    with clientCacheLock:
+        loaded = clientCache.get("credsLoaded")
+
+        if loaded is None or datetime.datetime.now() - loaded >= datetime.timedelta(hours=credsMaxAgeHours):
+            object = s3.get_object(Bucket=s3Bucket, Key=credsFile)
+            creds = json.loads(object['Body'].read())
+
+            # Read the Google API key from the creds file.
+            scope =['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
+            clientCache["gc"] = gspread.authorize(credentials)
+            clientCache["credsLoaded"] = datetime.datetime.now()
+            count_metric("CredentialsLoaded")
+
+        gc = clientCache["gc"]
+
+        # gspread 6 keeps the credentials (and login) on the client's HTTP client, rather than on the client itself.
+        httpClient = getattr(gc, "http_client", gc)
+
+        # The token's expiry is kept in UTC, without a time zone.
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if httpClient.auth.token is None or httpClient.auth.expiry is None or httpClient.auth.expiry - now < datetime.timedelta(seconds=tokenRefreshSeconds):
+            httpClient.login()
+            count_metric("TokenRefreshes")
+
+    return gc
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Token bucket used to pace Google Sheets calls. Tokens refill at the bucket's rate, up to a few seconds' worth for bursts.
+# Callers take a token and sleep until it has been earned, so waiting callers are served in order. The rate is cut in half
+# after a quota error and creeps back up to the configured rate as calls succeed. Counters record how the bucket was used.
+#------------------------------------------------------------------------------------------------------------------------------
+class TokenBucket:
+    def __init__ (self, perMinute):
+        self.maxRate = perMinute / 60
+        self.rate = self.maxRate
+        self.capacity = max(1, perMinute / 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters (self):
+        self.calls = 0
+        self.waited = 0.0
+        self.throttled = 0
+
+    def acquire (self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+
+            self.calls += 1
+            self.waited += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle (self):
+        with self.lock:
+            self.rate = max(self.maxRate / 8, self.rate / 2)
+            self.throttled += 1
+
+    def recover (self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 20)
+
+# Buckets shared by every Google Sheets call.
+sheetsReads = TokenBucket(sheetsReadsPerMinute)
+sheetsWrites = TokenBucket(sheetsWritesPerMinute)
+
+# Timings (ms, by phase) and counters for the current run, written out by emit_metrics.
+metricsLock = threading.Lock()
+metricTimings = {}
+metricCounts = {}
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Check whether an exception is the Google API telling us we've exceeded a quota.
+#------------------------------------------------------------------------------------------------------------------------------
+def is_quota_error (e):
+    return isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 429
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Make a Google Sheets call once the bucket allows it, retrying with backoff when a quota error comes back.
+#------------------------------------------------------------------------------------------------------------------------------
+def sheets_call (bucket, function, *args, **kwargs):
+    for attempt in range(0, sheetsRetries+1):
+        bucket.acquire()
+
+        try:
+            result = function(*args, **kwargs)
+
+        except gspread.exceptions.APIError as e:
+            if not is_quota_error(e) or attempt == sheetsRetries:
+                raise
+
+            bucket.throttle()
+
+            delay = random.uniform(1, min(60, 2 ** (attempt + 2)))
+            log ("Google API quota exceeded. Pausing for " + str(round(delay, 1)) + " seconds...")
+            time.sleep(delay)
+
+        else:
+            bucket.recover()
+            return result
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Make a Google Sheets read or write call, paced by the matching bucket.
+#------------------------------------------------------------------------------------------------------------------------------
+def sheets_read (function, *args, **kwargs):
+    return sheets_call(sheetsReads, function, *args, **kwargs)
+
+def sheets_write (function, *args, **kwargs):
+    return sheets_call(sheetsWrites, function, *args, **kwargs)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Clear the metrics at the start of a run. The buckets are module level, so their counters are cleared as well.
+#------------------------------------------------------------------------------------------------------------------------------
+def reset_metrics ():
+    with metricsLock:
+        metricTimings.clear()
+        metricCounts.clear()
+
+    sheetsReads.reset_counters()
+    sheetsWrites.reset_counters()
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Add to one of the run's counters (calls, retries, bytes, rows, etc.)
+#------------------------------------------------------------------------------------------------------------------------------
+def count_metric (name, value=1):
+    with metricsLock:
+        metricCounts[name] = metricCounts.get(name, 0) + value
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Time a phase of the run. Use as: with timed("Phase"): ...
+#------------------------------------------------------------------------------------------------------------------------------
+@contextmanager
+def timed (phase):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        milliseconds = (time.perf_counter() - start) * 1000
+
+        with metricsLock:
+            metricTimings.setdefault(phase, []).append(milliseconds)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Get a percentile from a sorted list of timings.
+#------------------------------------------------------------------------------------------------------------------------------
+def get_percentile (timings, percent):
+    return timings[min(len(timings)-1, int(len(timings) * percent / 100))]
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write the run's metrics. CloudWatch picks up the JSON line as Embedded Metric Format: each phase gets a call count and latency
+# percentiles (ms), plus a latency histogram as a plain property. A readable summary is also logged for local runs.
+#------------------------------------------------------------------------------------------------------------------------------
+def emit_metrics (functionName):
+    with metricsLock:
+        timings = {phase: sorted(values) for phase, values in metricTimings.items()}
+        counts = dict(metricCounts)
+
+    counts["SheetsReadCalls"] = sheetsReads.calls
+    counts["SheetsReadWaitSeconds"] = round(sheetsReads.waited, 3)
+    counts["SheetsWriteCalls"] = sheetsWrites.calls
+    counts["SheetsWriteWaitSeconds"] = round(sheetsWrites.waited, 3)
+    counts["SheetsQuotaErrors"] = sheetsReads.throttled + sheetsWrites.throttled
+
+    record = {"Function": functionName, "Histograms": {}}
+    definitions = []
+
+    for phase, values in timings.items():
+        record[phase + "Count"] = len(values)
+        record[phase + "P50"] = round(get_percentile(values, 50), 1)
+        record[phase + "P90"] = round(get_percentile(values, 90), 1)
+        record[phase + "P99"] = round(get_percentile(values, 99), 1)
+        record[phase + "Max"] = round(values[-1], 1)
+        record[phase + "Total"] = round(sum(values), 1)
+
+        definitions.append({"Name": phase + "Count", "Unit": "Count"})
+        for stat in ["P50", "P90", "P99", "Max", "Total"]:
+            definitions.append({"Name": phase + stat, "Unit": "Milliseconds"})
+
+        # Histogram of latencies in ms, by upper bound of each bucket.
+        histogram = {}
+        for value in values:
+            bucket = next((str(bound) for bound in metricsBuckets if value < bound), "More")
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        record["Histograms"][phase] = histogram
+
+        log ("Metrics - " + phase + ": " + str(len(values)) + " calls, p50 " + str(record[phase + "P50"]) + " ms, p90 " + str(record[phase + "P90"]) + " ms, max " + str(record[phase + "Max"]) + " ms, total " + str(round(sum(values)/1000, 1)) + " s.")
+
+    for name, value in counts.items():
+        record[name] = value
+
+        if name.endswith("Seconds"):
+            definitions.append({"Name": name, "Unit": "Seconds"})
+        elif name.endswith("Bytes"):
+            definitions.append({"Name": name, "Unit": "Bytes"})
+        else:
+            definitions.append({"Name": name, "Unit": "Count"})
+
+        log ("Metrics - " + name + ": " + str(value))
+
+    # Split the definitions across directives, so CloudWatch doesn't reject the whole record once there are too many phases.
+    directives = []
+    for i in range(0, len(definitions), metricsPerDirective):
+        directives.append({"Namespace": metricsNamespace, "Dimensions": [["Function"]], "Metrics": definitions[i:i+metricsPerDirective]})
+
+    record["_aws"] = {"Timestamp": int(time.time() * 1000), "CloudWatchMetrics": directives}
+    print(json.dumps(record))
+
 #------------------------------------------------------------------------------------------------------------------------------
 # Log a message and exit the program.
 #------------------------------------------------------------------------------------------------------------------------------
@@ -168,6 +510,201 @@ def end_function(msg=''):
     
     exit()
 
+#------------------------------------------------------------------------------------------------------------------------------
+# Read a JSON state file from the S3 bucket. Returns the default if the file does not exist yet.
+#------------------------------------------------------------------------------------------------------------------------------
+def load_state (s3, key, default):
+    try:
+        object = s3.get_object(Bucket=s3Bucket, Key=key)
+
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+            return default
+        raise
+
+    return json.loads(object['Body'].read())
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write a JSON state file to the S3 bucket.
+#------------------------------------------------------------------------------------------------------------------------------
+def save_state (s3, key, state):
+    s3.put_object(Bucket=s3Bucket, Key=key, Body=json.dumps(state).encode("utf-8"))
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build a stats sheet's first worksheet from its sheet index entry. gspread reads the spreadsheet's metadata to build these, so
+# build them directly (as gspread would from that metadata) to save the two read requests.
+#------------------------------------------------------------------------------------------------------------------------------
+def build_worksheet (gc, entry):
+    properties = {"sheetId": entry["sheetId"], "title": entry["title"], "index": 0, "gridProperties": dict(entry["gridProperties"])}
+
+    # Spreadsheet's constructor reads the metadata, so only set what the worksheet calls need.
+    docStats = gspread.Spreadsheet.__new__(gspread.Spreadsheet)
+    docStats._properties = {"id": entry["key"]}
+
+    # gspread 6 sends requests through the client's HTTP client, and a worksheet also needs the spreadsheet key and that client.
+    httpClient = getattr(gc, "http_client", None)
+
+    if httpClient is None:
+        docStats.client = gc
+        return gspread.Worksheet(docStats, properties)
+
+    docStats.client = httpClient
+    return gspread.Worksheet(docStats, properties, entry["key"], httpClient)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Read the columns we need (H through Y) from a profile's stats sheet. The worksheet is built from the sheet index when it has an
+# entry for the URL's key. If that entry turns out to be out of date, or there isn't one, the sheet is opened by URL instead.
+#------------------------------------------------------------------------------------------------------------------------------
+def read_stats_sheet (gc, sheetIndex, url):
+    entry = sheetIndex.get(gspread.utils.extract_id_from_url(url))
+
+    if entry is not None:
+        try:
+            with timed("ReadStatsSheet"):
+                values = sheets_read(build_worksheet(gc, entry).get_values, "H:Y")
+
+            count_metric("SheetIndexHits")
+            return values
+
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in [400, 404]:
+                raise
+
+            log("The sheet index entry for " + url + " is out of date. Opening it by URL instead.")
+
+    with timed("OpenSpreadsheet"):
+        docStats = sheets_read(gc.open_by_url, url)
+        sheetStats = sheets_read(docStats.get_worksheet, 0)
+
+    with timed("ReadStatsSheet"):
+        return sheets_read(sheetStats.get_values, "H:Y")
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Read a profile's totals from its stats sheet, in the same form Stats saves them to the summary store.
+#------------------------------------------------------------------------------------------------------------------------------
+def read_summary_record (gc, sheetIndex, url):
+    values = read_stats_sheet(gc, sheetIndex, url)
+
+    # Sum up each of the metrics
+    viewsCount = 0
+    favoritesCount = 0
+    for j in range(1, len(values)):
+        if values[j][2] != '':
+            viewsCount += int(values[j][2])
+
+        if values[j][3] != '':
+            favoritesCount += int(values[j][3])
+
+    # Followers and following are repeated so just get first row.
+    followersCount = int(values[1][16])
+    followingCount = int(values[1][17])
+
+    # Sum up visable vizzes only.
+    vizCount = 0
+    for j in range(1, len(values)):
+        if values[j][0]=='TRUE':
+            vizCount+=1
+
+    record = {}
+    record["favorites"] = favoritesCount
+    record["views"] = viewsCount
+    record["followers"] = followersCount
+    record["following"] = followingCount
+    record["vizzes"] = vizCount
+    record["refreshed"] = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+    return record
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Save the totals read from the stats sheets to the summary store. Stats saves the same file, so it's read again and only the
+# recomputed fields are written, leaving the rest (such as the views and favorites gained) as they are. Profiles that Stats
+# refreshed while we were running are skipped, since its totals are newer than what we read.
+#------------------------------------------------------------------------------------------------------------------------------
+def save_recomputed (s3, recomputed):
+    summaryStore = load_state(s3, summaryFile, {})
+
+    for url, (loaded, record) in recomputed.items():
+        current = summaryStore.get(url)
+
+        if current is not None and current.get("refreshed") != loaded:
+            continue
+
+        summaryStore.setdefault(url, {}).update(record)
+
+    save_state(s3, summaryFile, summaryStore)
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Build an export file from a header and rows: Parquet, or gzip CSV if pyarrow isn't installed or exportFormat is "csv". Returns
+# the file (ready to read) and its extension.
+#------------------------------------------------------------------------------------------------------------------------------
+def build_export (header, rows):
+    buffer = io.BytesIO()
+
+    # pyarrow is optional, and only imported here so runs without the export sink don't pay for loading it.
+    pyarrow = None
+    if exportFormat == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            pass
+
+    if pyarrow is not None:
+        columns = []
+
+        for c in range(0, len(header)):
+            values = [None if row[c] == '' else row[c] for row in rows]
+
+            try:
+                columns.append(pyarrow.array(values))
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                # Mixed types, so store the column as text.
+                columns.append(pyarrow.array([None if value is None else str(value) for value in values]))
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(columns, names=header), buffer, compression="snappy")
+        extension = ".parquet"
+
+    else:
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as zipped:
+            with io.TextIOWrapper(zipped, encoding="utf-8", newline="") as text:
+                writer = csv.writer(text)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+        extension = ".csv.gz"
+
+    buffer.seek(0)
+    return buffer, extension
+
+#------------------------------------------------------------------------------------------------------------------------------
+# Write a header and rows to exportLocation as one file, replacing the last export with the same name.
+#------------------------------------------------------------------------------------------------------------------------------
+def write_export (name, header, rows):
+    buffer, extension = build_export(header, rows)
+
+    with timed("WriteExport"):
+        if exportLocation.startswith("s3://"):
+            bucket, _, prefix = exportLocation[5:].partition("/")
+            key = (prefix.rstrip("/") + "/" if prefix != "" else "") + name + extension
+            get_aws_client('s3').upload_fileobj(buffer, bucket, key)
+
+        else:
+            path = os.path.join(exportLocation, name + extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(path, "wb") as f:
+                f.write(buffer.getvalue())
+
+#------------------------------------------------------------------------------------------------------------------------------
+# The summary values are text, as they're written to the sheet. For the export, turn whole numbers back into numbers.
+# Anything else (such as a blank) is left as is.
+#------------------------------------------------------------------------------------------------------------------------------
+def export_value (value):
+    if isinstance(value, str) and value.lstrip("-").isdigit():
+        return int(value)
+
+    return value
+
 #------------------------------------------------------------------------------------------------------------------------------
 # Main lambda handler
 #------------------------------------------------------------------------------------------------------------------------------
@@ -176,31 +713,39 @@ def lambda_handler(event, context):
 
     log("Summarizing the stats for all users.")
 
-    # Get the Google Sheets credentials from S3
-    s3 = boto3.client('s3')
-    key = credsFile
-    object = s3.get_object(Bucket=s3Bucket, Key=key)
-    content = object['Body']
-    creds = json.loads(content.read())
+    reset_metrics()
 
-    # Read your Google API key from a local json file.
-    scope =['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
-    gc = gspread.authorize(credentials) 
+    # Get the Google Sheets client, reading the credentials from S3 on a cold start.
+    gc = get_sheets_client()
 
     # Read the sign-up and summary sheets.
-    docProfiles = gc.open_by_url('https://docs.google.com/spreadsheets/d/' + worksheetID)
-    sheetProfiles = docProfiles.worksheet("Form Responses 1")
-    sheetSummary = docProfiles.worksheet("Summary")
-
-    # Get columns from the profiles sheet.
-    emailList = sheetProfiles.col_values(2)
-    firstnameList = sheetProfiles.col_values(3)
-    lastnameList = sheetProfiles.col_values(4)
-    profileList = sheetProfiles.col_values(5)
-    urlList = sheetProfiles.col_values(6)
-    dateList = sheetProfiles.col_values(7)
-    profileCount = len(emailList)-1
+    with timed("ReadSignup"):
+        docProfiles = sheets_read(gc.open_by_url, 'https://docs.google.com/spreadsheets/d/' + worksheetID)
+        sheetProfiles = sheets_read(docProfiles.worksheet, "Form Responses 1")
+        sheetSummary = sheets_read(docProfiles.worksheet, "Summary")
+
+        # Get columns from the profiles sheet.
+        emailList = sheets_read(sheetProfiles.col_values, 2)
+        firstnameList = sheets_read(sheetProfiles.col_values, 3)
+        lastnameList = sheets_read(sheetProfiles.col_values, 4)
+        profileList = sheets_read(sheetProfiles.col_values, 5)
+        urlList = sheets_read(sheetProfiles.col_values, 6)
+        dateList = sheets_read(sheetProfiles.col_values, 7)
+        profileCount = len(emailList)-1
+
+    # Read the previous summary once, so profiles that fail can fall back to their old row without any more API calls.
+    with timed("ReadSummary"):
+        summaryValues = sheets_read(sheetSummary.get_values, "A:M")
+
+    # Load the totals Stats saves for each profile. A full recompute (event {"fullRecompute": true}) reads every stats sheet
+    # again instead.
+    s3 = get_aws_client('s3')
+    summaryStore = load_state(s3, summaryFile, {})
+
+    # Load the stats sheet index (kept by Stats), so the sheets we do read are read without their metadata.
+    sheetIndex = load_state(s3, sheetIndexFile, {})
+    fullRecompute = event.get("fullRecompute", False) == True
+    recomputed = {}
 
     matrix = {}
     refreshDate = datetime.datetime.today().strftime("%Y-%m-%d %H:%M:%S")
@@ -209,93 +754,112 @@ def lambda_handler(event, context):
         log("Proessing profile " + str(i) + " of " + str(profileCount))
         
         try:
-            # Open each sheet then summarize the stats.
-            docStats = gc.open_by_url(urlList[i])
-            sheetStats = docStats.get_worksheet(0)
-
-            # Sum up each of the metrics
-            views = sheetStats.col_values(10)
-            viewsCount = 0
-            for j in range(1, len(views)):
-                viewsCount += int(views[j])
-
-            favorites = sheetStats.col_values(11)
-            favoritesCount = 0
-            for j in range(1, len(favorites)):
-                favoritesCount += int(favorites[j])
-
-            # Followers and following are repeated so just get first row.
-            followers = sheetStats.col_values(24)
-            followersCount = int(followers[1])
-
-            following = sheetStats.col_values(25)
-            followingCount = int(following[1])
-
-            # Sum up visable vizzes only.
-            visable = sheetStats.col_values(8)
-            vizCount = 0
-            for j in range(1, len(visable)):
-                if visable[j]=='TRUE':
-                    vizCount+=1
+            # Use the totals Stats saved when it last refreshed the profile. If there aren't any (or for a full recompute),
+            # read them from the stats sheet and save them for next time. Fields only Stats computes are kept.
+            record = summaryStore.get(urlList[i])
+
+            if fullRecompute == True or record is None:
+                stored = summaryStore.get(urlList[i], {})
+                totals = read_summary_record(gc, sheetIndex, urlList[i])
+                recomputed[urlList[i]] = (stored.get("refreshed"), totals)
+
+                record = dict(stored)
+                record.update(totals)
 
             # Write to the matrix
             matrix[i, 0] = firstnameList[i]
             matrix[i, 1] = lastnameList[i]
             matrix[i, 2] = profileList[i]
             matrix[i, 3] = urlList[i]
-            matrix[i, 4] = str(favoritesCount)
-            matrix[i, 5] = str(viewsCount)
-            matrix[i, 6] = str(followersCount)
-            matrix[i, 7] = str(followingCount)
-            matrix[i, 8] = str(vizCount)
+            matrix[i, 4] = str(record["favorites"])
+            matrix[i, 5] = str(record["views"])
+            matrix[i, 6] = str(record["followers"])
+            matrix[i, 7] = str(record["following"])
+            matrix[i, 8] = str(record["vizzes"])
             matrix[i, 9] = dateList[i]
             matrix[i,10] = refreshDate 
+            matrix[i,11] = str(record.get("viewsGained", ""))
+            matrix[i,12] = str(record.get("favoritesGained", ""))
+
+            count_metric("ProfilesSummarized")
 
         except Exception as e:
             # Google API can be finicky. 
-            # Use the existing values, log the error, pause before continuing.
-            matrix[i, 0]  = sheetSummary.col_values(1)[i]
-            matrix[i, 1]  = sheetSummary.col_values(2)[i]
-            matrix[i, 2]  = sheetSummary.col_values(3)[i]
-            matrix[i, 3]  = sheetSummary.col_values(4)[i]
-            matrix[i, 4]  = sheetSummary.col_values(5)[i]
-            matrix[i, 5]  = sheetSummary.col_values(6)[i]
-            matrix[i, 6]  = sheetSummary.col_values(7)[i]
-            matrix[i, 7]  = sheetSummary.col_values(8)[i]
-            matrix[i, 8]  = sheetSummary.col_values(9)[i]
-            matrix[i, 9]  = sheetSummary.col_values(10)[i]
-            matrix[i,10]  = sheetSummary.col_values(11)[i]
+            # Use the existing values and log the error. Quota errors have already been retried by sheets_call.
+            if i < len(summaryValues):
+                previous = summaryValues[i] + [''] * (13 - len(summaryValues[i]))
+            else:
+                previous = [''] * 13
+
+            for column in range(0, 13):
+                matrix[i, column] = previous[column]
 
             # Log the error.
-            msg = "Error processing profile # " + str(i) + " (" + sheetSummary.col_values(1)[i] + " " + sheetSummary.col_values(2)[i] + "): " + str(sys.exc_info()[0]) + " - " + str(e) 
+            msg = "Error processing profile # " + str(i) + " (" + previous[0] + " " + previous[1] + "): " + str(sys.exc_info()[0]) + " - " + str(e) 
             log (msg)
 
             subject = "Tableau Public Stats Sumarization Error"
-            phone_home (subject, msg)
+            report_error(subject, "Google Sheets", msg, e)
 
-            msg = "Pausing for 10 seconds..."
-            log (msg)
-
-            time.sleep(10)
+            count_metric("ProfilesNotSummarized")
             continue
 
+    # Keep the existing headings, adding the ones for the views and favorites gained columns.
+    header = summaryValues[0] + [''] * (13 - len(summaryValues[0])) if len(summaryValues) > 0 else [''] * 13
+    header[11] = "Views Gained (Last " + str(historyDeltaDays) + " Days)"
+    header[12] = "Favorites Gained (Last " + str(historyDeltaDays) + " Days)"
+
+    for column in range(0, 13):
+        matrix[0, column] = header[column]
+
     # Write the matrix array to the Summary Sheet.
-    log("Writing summary stats to sheet.")
-    rangeString = "A2:K" + str(profileCount+1)
-    cell_list = sheetSummary.range(rangeString)
-
-    row = 1
-    column = 0
-
-    for cell in cell_list: 
-        cell.value = matrix[row,column]
-        column += 1
-        if (column > 10):
-            column=0
-            row += 1
-
-    # Update in batch   
-    sheetSummary.update_cells(cell_list)
+    if "sheets" in outputSinks:
+        log("Writing summary stats to sheet.")
+        rangeString = "A1:M" + str(profileCount+1)
+        with timed("WriteSummary"):
+            cell_list = sheets_read(sheetSummary.range, rangeString)
+
+            row = 0
+            column = 0
+
+            for cell in cell_list: 
+                cell.value = matrix[row,column]
+                column += 1
+                if (column > 12):
+                    column=0
+                    row += 1
+
+            # Update in batch   
+            sheets_write(sheetSummary.update_cells, cell_list)
+
+    # Write the same rows to the export file, with the counts (favorites through vizzes, and the gains) as numbers. Columns
+    # without a heading are named by position.
+    if "export" in outputSinks:
+        log("Exporting summary stats.")
+        try:
+            numberColumns = [4, 5, 6, 7, 8, 11, 12]
+            exportHeader = [header[column] if header[column] != '' else "Column " + str(column+1) for column in range(0, 13)]
+            exportRows = [[export_value(matrix[i, column]) if column in numberColumns else matrix[i, column] for column in range(0, 13)] for i in range(1, profileCount+1)]
+            write_export("summary", exportHeader, exportRows)
+
+        except Exception as e:
+            msg = "Unable to export the summary. Error: " + str(sys.exc_info()[0]) + " - " + str(e)
+            log (msg)
+
+            subject = "Tableau Public Stats Sumarization Error"
+            report_error(subject, "Export", msg, e)
+
+    count_metric("RowsWritten", profileCount)
+    count_metric("ProfilesRecomputed", len(recomputed))
+
+    # Save any totals read from the stats sheets.
+    if len(recomputed) > 0:
+        save_recomputed(s3, recomputed)
+
+    # Send the errors as one digest.
+    send_error_digest()
+
+    emit_metrics("Summarize")
        
 
 #------------------------------------------------------------------------------------------------------------------------------